@@ -0,0 +1,734 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2016 Turbo Fredriksson <turbo@bayour.com>
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Tests for the ZFS-on-Linux driver.
+
+Copy to cinder/tests/unit/volume/drivers/ (next to zol.py in
+cinder/volume/drivers/) and run with the Cinder unit tests.
+"""
+
+import hashlib
+import json
+import tempfile
+import time
+
+import mock
+from oslo_concurrency import processutils
+from oslo_utils import units
+from oslo_utils import uuidutils
+
+from cinder import exception
+from cinder import test
+from cinder import utils
+from cinder.volume import configuration as conf
+from cinder.volume.drivers import zol
+
+
+class ZFSonLinuxTestCase(test.TestCase):
+    """Driver running locally, with its volumes in tank/cinder."""
+
+    def setUp(self):
+        super(ZFSonLinuxTestCase, self).setUp()
+        self.mock_object(zol.importutils, 'import_object')
+
+        self.configuration = conf.Configuration(None)
+        self.configuration.san_is_local = True
+        self.configuration.san_ip = '10.0.0.1'
+        self.configuration.san_login = 'root'
+        self.configuration.san_zfs_volume_base = 'tank/cinder'
+        self._configure()
+        self.driver = self._create_driver()
+
+    def _configure(self):
+        """Change self.configuration before the driver is created."""
+
+    def _create_driver(self):
+        driver = zol.ZFSonLinuxISCSIDriver(configuration=self.configuration)
+        driver.run_local = self.configuration.san_is_local
+        return driver
+
+
+class ZFSonLinuxManageableTestCase(ZFSonLinuxTestCase):
+    def setUp(self):
+        super(ZFSonLinuxManageableTestCase, self).setUp()
+        self.execute = mock.Mock(return_value=('', ''))
+        self.driver.set_execute(self.execute)
+
+    def _zfs_list(self, count):
+        lines = []
+        for i in range(count):
+            lines.append('tank/cinder/vol%05d\tvolume\t%d\t0\toff'
+                         % (i, (i % 10 + 1) * units.Gi))
+            lines.append('tank/cinder/vol%05d@snap\tsnapshot\t%d\t0\t-'
+                         % (i, (i % 10 + 1) * units.Gi))
+        return ('\n'.join(reversed(lines)) + '\n', '')
+
+    def test_get_manageable_volumes_is_one_command(self):
+        self.execute.return_value = self._zfs_list(10000)
+
+        volumes = self.driver.get_manageable_volumes([], None, 1000, 0,
+                                                     ['reference'], ['asc'])
+
+        self.assertEqual(1, self.execute.call_count)
+        self.assertEqual(1000, len(volumes))
+        self.assertEqual({'source-name': 'vol00000'},
+                         volumes[0]['reference'])
+        self.assertEqual(1, volumes[0]['size'])
+        self.assertTrue(volumes[0]['safe_to_manage'])
+
+        volumes = self.driver.get_manageable_volumes(
+            [], volumes[-1]['reference'], 1000, 0, ['reference'], ['asc'])
+
+        self.assertEqual(2, self.execute.call_count)
+        self.assertEqual({'source-name': 'vol01000'},
+                         volumes[0]['reference'])
+
+    def test_get_manageable_snapshots_is_one_command(self):
+        self.execute.return_value = self._zfs_list(10000)
+
+        snapshots = self.driver.get_manageable_snapshots([], None, None, 0,
+                                                         None, None)
+
+        self.assertEqual(1, self.execute.call_count)
+        self.assertEqual(10000, len(snapshots))
+        self.assertEqual({'source-name': 'vol00000@snap'},
+                         snapshots[0]['reference'])
+        self.assertEqual({'source-name': 'vol00000'},
+                         snapshots[0]['source_reference'])
+
+    def test_paginate_entries_sort_keys(self):
+        entries = [{'reference': {'source-name': name}, 'size': size}
+                   for name, size in (('a', 3), ('b', 1), ('c', 1))]
+
+        result = self.driver._paginate_entries(list(entries), None, None, 0,
+                                               ['reference', 'size'],
+                                               ['asc', 'asc'])
+        self.assertEqual(['a', 'b', 'c'],
+                         [e['reference']['source-name'] for e in result])
+
+        result = self.driver._paginate_entries(list(entries), None, None, 0,
+                                               ['size', 'reference'],
+                                               ['asc', 'desc'])
+        self.assertEqual(['c', 'b', 'a'],
+                         [e['reference']['source-name'] for e in result])
+
+    def test_paginate_entries_bad_marker(self):
+        self.assertRaises(exception.InvalidInput,
+                          self.driver._paginate_entries, [],
+                          {'source-name': 'missing'}, None, 0, None, None)
+
+    def test_manage_existing_get_size_missing(self):
+        self.execute.side_effect = processutils.ProcessExecutionError(
+            exit_code=1, stderr='dataset does not exist')
+
+        self.assertRaises(exception.ManageExistingInvalidReference,
+                          self.driver.manage_existing_get_size,
+                          {}, {'source-name': 'missing'})
+        self.assertTrue(self.execute.call_args[1]['check_exit_code'])
+
+    def test_manage_existing_get_size_filesystem(self):
+        self.execute.return_value = ('-\n', '')
+
+        self.assertRaises(exception.ManageExistingInvalidReference,
+                          self.driver.manage_existing_get_size,
+                          {}, {'source-name': 'fs'})
+
+    def test_manage_existing_not_below_base(self):
+        for source in ('.warm/spare-a', 'vol@snap'):
+            self.assertRaises(exception.ManageExistingInvalidReference,
+                              self.driver.manage_existing,
+                              {'name': 'volume-b'}, {'source-name': source})
+        self.assertFalse(self.execute.called)
+
+    def test_manage_existing_logs_out_sessions(self):
+        target = 'iqn.2012-11.com.bayour:tank.cinder.my.vol'
+        host_execute = mock.Mock(side_effect=[
+            ('10.0.0.1:3260,1 %s\n' % target, ''),
+            ('tcp: [1] 10.0.0.1:3260,1 %s (non-flash)\n' % target, '')])
+        self.driver.set_host_execute(host_execute)
+        logout = self.mock_object(self.driver, '_logout_target',
+                                  return_value=True)
+        self.execute.return_value = ('%d\n' % units.Gi, '')
+
+        self.driver.manage_existing({'name': 'volume-b'},
+                                    {'source-name': 'my-vol'})
+
+        logout.assert_called_once_with('10.0.0.1:3260', target)
+        self.execute.assert_called_with('zfs', 'rename', 'tank/cinder/my-vol',
+                                        'tank/cinder/volume-b',
+                                        run_as_root=True, check_exit_code=True)
+
+    def test_get_manageable_volumes_unmanaged_cinder_name(self):
+        name = 'volume-%s' % uuidutils.generate_uuid()
+        self.execute.return_value = ('tank/cinder/%s\tvolume\t%d\t0\toff\n'
+                                     % (name, units.Gi), '')
+
+        volumes = self.driver.get_manageable_volumes([], None, None, 0,
+                                                     None, None)
+
+        self.assertTrue(volumes[0]['safe_to_manage'])
+
+
+class ZFSonLinuxRevertTestCase(ZFSonLinuxTestCase):
+    def setUp(self):
+        super(ZFSonLinuxRevertTestCase, self).setUp()
+        self.mock_object(self.driver, '_find_target', return_value=False)
+
+        self.volume = {'name': 'volume-a', 'name_id': 'a', 'size': 2}
+        self.snapshot = {'name': 'snap', 'volume_size': 1}
+
+    def _execute(self, rollback_error=None):
+        def execute(*cmd, **kwargs):
+            if cmd[1] == 'list':
+                return ('tank/cinder/volume-a@snap\t10\t-\n'
+                        'tank/cinder/volume-a@newer\t20\t-\n', '')
+            if cmd[1] == 'rollback' and rollback_error:
+                raise rollback_error
+            return ('', '')
+        return mock.Mock(side_effect=execute)
+
+    def test_revert_to_snapshot(self):
+        execute = self._execute()
+        self.driver.set_execute(execute)
+
+        self.driver.revert_to_snapshot(None, self.volume, self.snapshot)
+
+        execute.assert_any_call('zfs', 'rollback', '-r',
+                                'tank/cinder/volume-a@snap',
+                                run_as_root=True, check_exit_code=True)
+        execute.assert_called_with('zfs', 'set', 'volsize=2G',
+                                   'tank/cinder/volume-a',
+                                   run_as_root=True, check_exit_code=True)
+
+    def test_revert_to_snapshot_rollback_fails(self):
+        execute = self._execute(processutils.ProcessExecutionError(
+            exit_code=1, stderr='more recent snapshots exist'))
+        self.driver.set_execute(execute)
+
+        self.assertRaises(processutils.ProcessExecutionError,
+                          self.driver.revert_to_snapshot,
+                          None, self.volume, self.snapshot)
+        self.assertNotIn('set', [c[0][1] for c in execute.call_args_list])
+
+    def test_revert_to_snapshot_newer_cinder_snapshot(self):
+        newer = 'snapshot-%s' % uuidutils.generate_uuid()
+        execute = mock.Mock(return_value=(
+            'tank/cinder/volume-a@snap\t10\t-\n'
+            'tank/cinder/volume-a@%s\t20\t-\n' % newer, ''))
+        self.driver.set_execute(execute)
+
+        self.assertRaises(exception.VolumeBackendAPIException,
+                          self.driver.revert_to_snapshot,
+                          None, self.volume, self.snapshot)
+        self.assertEqual(1, execute.call_count)
+
+    def test_snapshot_revert_use_temp_snapshot(self):
+        # Or the manager's temporary snapshot would block every revert.
+        self.assertFalse(self.driver.snapshot_revert_use_temp_snapshot())
+
+
+class LibZFSCoreExecutorTestCase(test.TestCase):
+    """The in-process ZFS backend, with a mocked libzfs_core."""
+
+    class ZFSError(Exception):
+        pass
+
+    def setUp(self):
+        super(LibZFSCoreExecutorTestCase, self).setUp()
+        self.lzc = self.mock_object(zol, 'libzfs_core')
+        self.lzc.is_supported.return_value = True
+        self.mock_object(zol, 'zfs_exceptions',
+                         mock.Mock(ZFSError=self.ZFSError))
+        self.executor = zol.LibZFSCoreExecutor()
+
+    def test_create(self):
+        self.assertEqual(('', ''), self.executor(
+            'zfs', 'create', '-s', '-V', '2G', '-o', 'compression=lz4',
+            '-o', 'sync=always', '-o', 'org.openstack:replication=on',
+            'tank/cinder/volume-1'))
+
+        self.lzc.lzc_create.assert_called_once_with(
+            'tank/cinder/volume-1', ds_type='zvol',
+            props={'volsize': 2 * units.Gi, 'compression': 15, 'sync': 1,
+                   'org.openstack:replication': 'on'})
+
+    def test_prop_index(self):
+        # The zio_compress, zio_checksum and zfs_sync_type_t enums.
+        compression = zol.ZFS_PROP_INDEX['compression']
+        self.assertEqual((1, 2, 3, 15), (compression['on'], compression['off'],
+                                         compression['lzjb'],
+                                         compression['lz4']))
+        self.assertEqual(compression['gzip-6'], compression['gzip'])
+        self.assertEqual(range(5, 14), [compression['gzip-%d' % level]
+                                        for level in range(1, 10)])
+        self.assertEqual(7, zol.ZFS_PROP_INDEX['checksum']['fletcher4'])
+        self.assertEqual(8 | 256, zol.ZFS_PROP_INDEX['dedup']['sha256,verify'])
+        self.assertEqual({'standard': 0, 'always': 1, 'disabled': 2},
+                         zol.ZFS_PROP_INDEX['sync'])
+
+    def test_falls_back_to_cli(self):
+        # Not zfs, a subcommand or an option it doesn't handle, a thick
+        # volume and a property it doesn't know the value of.
+        for cmd in (('zpool', 'list'),
+                    ('zfs', 'send', 'tank/cinder/volume-1@snap'),
+                    ('zfs', 'list', '-Hd1', 'tank/cinder'),
+                    ('zfs', 'create', '-V', '1G', 'tank/cinder/volume-1'),
+                    ('zfs', 'set', 'compression=zstd',
+                     'tank/cinder/volume-1')):
+            self.assertIsNone(self.executor(*cmd))
+        self.assertFalse(self.lzc.lzc_create.called)
+        self.assertFalse(self.lzc.lzc_set_prop.called)
+
+    def test_falls_back_to_cli_if_unsupported(self):
+        self.lzc.is_supported.return_value = False
+
+        self.assertIsNone(self.executor('zfs', 'rename', 'tank/cinder/a',
+                                        'tank/cinder/b'))
+        self.assertIsNone(self.executor('zfs', 'destroy', 'tank/cinder/a'))
+        self.assertFalse(self.lzc.lzc_rename.called)
+        self.assertFalse(self.lzc.lzc_destroy.called)
+
+    def test_set_volsize_sparse(self):
+        self.lzc.lzc_get_props.return_value = {'volsize': units.Gi}
+
+        self.assertEqual(('', ''), self.executor(
+            'zfs', 'set', 'volsize=2G', 'tank/cinder/volume-1'))
+
+        self.lzc.lzc_set_prop.assert_called_once_with(
+            'tank/cinder/volume-1', 'volsize', 2 * units.Gi)
+
+    def test_set_volsize_thick(self):
+        self.lzc.lzc_get_props.return_value = {'volsize': units.Gi,
+                                               'refreservation': units.Gi}
+
+        self.assertIsNone(self.executor('zfs', 'set', 'volsize=2G',
+                                        'tank/cinder/volume-1'))
+        self.assertFalse(self.lzc.lzc_set_prop.called)
+
+    def test_zfs_error(self):
+        self.lzc.lzc_snapshot.side_effect = self.ZFSError('no space')
+
+        exc = self.assertRaises(processutils.ProcessExecutionError,
+                                self.executor, 'zfs', 'snapshot',
+                                'tank/cinder/volume-1@snap')
+        self.assertEqual(1, exc.exit_code)
+        self.assertEqual('no space', exc.stderr)
+
+        self.assertEqual(('', 'no space'), self.executor(
+            'zfs', 'snapshot', 'tank/cinder/volume-1@snap',
+            check_exit_code=False))
+
+
+class ZFSonLinuxReplicationTestCase(ZFSonLinuxTestCase):
+    """Replication, with the ZFS hosts reached over SSH."""
+
+    def _configure(self):
+        self.configuration.san_is_local = False
+        self.configuration.replication_device = [{
+            'backend_id': 'dr', 'san_ip': '10.0.0.2',
+            'san_zfs_volume_base': 'share/cinder'}]
+
+    def setUp(self):
+        super(ZFSonLinuxReplicationTestCase, self).setUp()
+        self.mock_object(self.driver, '_is_replicated', return_value=True)
+        self.mock_object(self.driver, '_run_ssh', side_effect=self._run_ssh)
+
+        self.commands = []
+        self.failures = {}
+        self.outputs = {}
+
+    def _run_ssh(self, command, check_exit_code=True):
+        utils.check_ssh_injection(command.split(' '))
+        self.commands.append(command)
+        for pattern, output in self.outputs.items():
+            if pattern in command:
+                return (output, '')
+        for pattern in list(self.failures):
+            if pattern in command:
+                self.failures[pattern] -= 1
+                if not self.failures[pattern]:
+                    del self.failures[pattern]
+                if not check_exit_code:
+                    return ('', 'failed: %s' % pattern)
+                raise processutils.ProcessExecutionError(
+                    exit_code=1, stderr='failed: %s' % pattern)
+        return ('', '')
+
+    def _sends(self):
+        return [command for command in self.commands
+                if command.startswith('zol-replicate send ')]
+
+    def _replicate(self):
+        return self.driver._replicate_volume('volume-a', [
+            {'name': 'tank/cinder/volume-a@replication-1', 'creation': '1'}])
+
+    def test_replicate_volume_incremental(self):
+        self.assertTrue(self._replicate())
+
+        sends = self._sends()
+        self.assertEqual(1, len(sends))
+        self.assertTrue(sends[0].startswith(
+            'zol-replicate send root@10.0.0.2 share/cinder/volume-a '
+            '-I tank/cinder/volume-a@replication-1 '
+            'tank/cinder/volume-a@replication-'))
+
+    def test_replicate_volume_local(self):
+        self.driver.run_local = True
+        execute = mock.Mock(return_value=('', ''))
+        self.driver.set_execute(execute)
+
+        self.assertTrue(self._replicate())
+
+        args, kwargs = execute.call_args_list[1]
+        self.assertEqual(('zol-replicate', 'send', 'root@10.0.0.2',
+                          'share/cinder/volume-a', '-I',
+                          'tank/cinder/volume-a@replication-1'), args[:6])
+        self.assertEqual({'run_as_root': True, 'check_exit_code': True},
+                         kwargs)
+
+    def test_replicate_volume_base_missing(self):
+        self.failures = {' -I ': 1}
+        self.outputs = {
+            ' list -Hr': 'share/cinder/volume-a@replication-0\n',
+            ' list -Hpr': 'tank/cinder/volume-a@snapshot-a\t3\n'
+                          'tank/cinder/volume-a@replication-1\t5\n'}
+
+        self.assertTrue(self._replicate())
+
+        self.assertIn('zol-replicate zfs root@10.0.0.2 destroy -r '
+                      'share/cinder/volume-a', self.commands)
+        sends = self._sends()
+        self.assertEqual(3, len(sends))
+        self.assertTrue(sends[1].endswith(
+            ' share/cinder/volume-a tank/cinder/volume-a@snapshot-a'))
+        self.assertIn(' -I tank/cinder/volume-a@snapshot-a ', sends[2])
+
+    def test_replicate_volume_newer_on_secondary(self):
+        self.failures = {' -I ': 1}
+        self.outputs = {' list -Hr': 'share/cinder/volume-a@replication-1\n'
+                                     'share/cinder/volume-a@replication-2\n'}
+
+        self.assertTrue(self._replicate())
+
+        self.assertIn('zol-replicate zfs root@10.0.0.2 rollback -r '
+                      'share/cinder/volume-a@replication-1', self.commands)
+        sends = self._sends()
+        self.assertEqual(2, len(sends))
+        self.assertIn(' -I ', sends[1])
+
+    def test_replicate_volume_fails(self):
+        self.failures = {' -I ': 1}
+        self.outputs = {' list -Hr': 'share/cinder/volume-a@replication-1\n'}
+
+        self.assertFalse(self._replicate())
+
+        self.assertEqual(1, len(self._sends()))
+        self.assertTrue(self.commands[-1].startswith(
+            'zfs destroy tank/cinder/volume-a@replication-'))
+
+    def _failover(self):
+        self.driver.failover_host(None, [], 'dr')
+        self.assertEqual('share/cinder',
+                         self.configuration.san_zfs_volume_base)
+        self.commands = []
+
+    def test_failback_sends_volumes_back(self):
+        self._failover()
+        self.outputs = {
+            ' list -Hpr': 'share/cinder/volume-a@replication-1\t5\n'}
+
+        backend_id, updates = self.driver.failover_host(
+            None, [{'id': 'a', 'name': 'volume-a'}], 'default')
+
+        self.assertEqual('default', backend_id)
+        self.assertEqual('tank/cinder', self.configuration.san_zfs_volume_base)
+        sends = self._sends()
+        self.assertEqual(1, len(sends))
+        self.assertTrue(sends[0].startswith(
+            'zol-replicate send root@10.0.0.1 tank/cinder/volume-a '
+            '-I share/cinder/volume-a@replication-1 '
+            'share/cinder/volume-a@replication-'))
+
+    def test_failback_send_fails(self):
+        self._failover()
+        self.outputs = {
+            ' list -Hpr': 'share/cinder/volume-a@replication-1\t5\n'}
+        self.failures = {' send ': 1}
+
+        self.assertRaises(exception.UnableToFailOver,
+                          self.driver.failover_host,
+                          None, [{'id': 'a', 'name': 'volume-a'}], 'default')
+        self.assertEqual('share/cinder',
+                         self.configuration.san_zfs_volume_base)
+
+    def test_failback_volume_created_while_failed_over(self):
+        self._failover()
+        self.outputs = {
+            ' list -Hpr': 'share/cinder/volume-a@snapshot-a\t3\n'}
+
+        self.driver.failover_host(None, [{'id': 'a', 'name': 'volume-a'}],
+                                  'default')
+
+        self.assertIn('zol-replicate zfs root@10.0.0.1 destroy -r '
+                      'tank/cinder/volume-a', self.commands)
+        sends = self._sends()
+        self.assertEqual(2, len(sends))
+        self.assertTrue(sends[0].endswith(
+            ' tank/cinder/volume-a share/cinder/volume-a@snapshot-a'))
+        self.assertIn(' -I share/cinder/volume-a@snapshot-a ', sends[1])
+
+    def test_manage_existing_replicated(self):
+        self.mock_object(self.driver, '_find_dataset_target',
+                         return_value=False)
+        self.outputs = {' get ': '%d\n' % units.Gi}
+
+        self.assertEqual({'replication_status': 'enabled'},
+                         self.driver.manage_existing(
+                             {'name': 'volume-a'}, {'source-name': 'vol'}))
+        self.assertEqual('zfs set org.openstack:replication=on '
+                         'tank/cinder/volume-a', self.commands[-1])
+
+    def test_unmanage(self):
+        self.driver.unmanage({'name': 'volume-a'})
+
+        self.assertIn('zol-replicate zfs root@10.0.0.2 destroy -r '
+                      'share/cinder/volume-a', self.commands)
+        self.assertEqual('zfs inherit org.openstack:replication '
+                         'tank/cinder/volume-a', self.commands[-1])
+
+    def test_retype_disables_replication(self):
+        self.mock_object(self.driver, '_is_replicated_type',
+                         return_value=False)
+
+        self.assertEqual((True, {'replication_status': 'disabled'}),
+                         self.driver.retype(
+                             None, {'name': 'volume-a', 'host': 'h@zol#zol'},
+                             {'id': 'plain'}, {}, {'host': 'h@zol#zol'}))
+        self.assertEqual('zfs inherit org.openstack:replication '
+                         'tank/cinder/volume-a', self.commands[-1])
+
+    def test_retype_to_other_backend(self):
+        self.assertFalse(self.driver.retype(
+            None, {'name': 'volume-a', 'host': 'h@zol#zol'},
+            {'id': 'plain'}, {}, {'host': 'h@lvm#lvm'}))
+        self.assertEqual([], self.commands)
+
+    def test_check_for_setup_error_replication_device(self):
+        self.driver.check_for_setup_error()
+
+        del self.configuration.replication_device[0]['san_zfs_volume_base']
+        self.assertRaises(exception.InvalidInput,
+                          self._create_driver().check_for_setup_error)
+
+
+class ZFSonLinuxTraceTestCase(ZFSonLinuxTestCase):
+    def _configure(self):
+        self.trace_file = tempfile.NamedTemporaryFile(suffix='.trace')
+        self.addCleanup(self.trace_file.close)
+
+        self.configuration.san_is_local = False
+        self.configuration.zol_trace_file = self.trace_file.name
+        self.configuration.replication_device = [{
+            'backend_id': 'dr', 'san_ip': '10.0.0.2',
+            'san_zfs_volume_base': 'share/cinder'}]
+
+    def _records(self):
+        with open(self.trace_file.name) as trace:
+            return [json.loads(line) for line in trace]
+
+    def test_unchecked_command_records_exit_code(self):
+        driver = self.driver
+        run_ssh = self.mock_object(driver, '_run_ssh')
+        driver.sshpool = mock.MagicMock()
+        ssh = driver.sshpool.item.return_value.__enter__.return_value
+        ssh_execute = self.mock_object(
+            zol.processutils, 'ssh_execute',
+            side_effect=processutils.ProcessExecutionError(
+                exit_code=1, stdout='', stderr='dataset does not exist'))
+
+        self.assertEqual(('', 'dataset does not exist'),
+                         driver._execute('zfs', 'destroy', 'tank/cinder/x'))
+        ssh_execute.assert_called_once_with(ssh, 'zfs destroy tank/cinder/x',
+                                            check_exit_code=True)
+        self.assertRaises(processutils.ProcessExecutionError,
+                          driver._execute, 'zfs', 'destroy', 'tank/cinder/x',
+                          check_exit_code=True)
+
+        # Not through _run_ssh(), which logs and sleeps on errors.
+        self.assertFalse(run_ssh.called)
+        self.assertEqual([1, 1], [record['exit']
+                                  for record in self._records()])
+
+    def _write_trace(self, *records):
+        with open(self.trace_file.name, 'w') as trace:
+            for record in records:
+                trace.write(json.dumps(dict({'op': '1', 'start': 0,
+                                             'elapsed': 0}, **record)) + '\n')
+
+    def test_replay_after_failover_host(self):
+        self._write_trace(
+            {'t': 'op', 'id': '1', 'op': 'failover_host',
+             'args': [None, [], 'dr'], 'kwargs': {}, 'commands': 0,
+             'error': False},
+            {'t': 'cmd', 'via': 'execute', 'exit': 0,
+             'argv': ['zfs', 'snapshot', 'share/cinder/volume-a@snap']},
+            {'t': 'op', 'id': '2', 'op': 'create_snapshot', 'start': 1,
+             'args': [{'name': 'snap', 'volume_name': 'volume-a'}],
+             'kwargs': {}, 'commands': 1, 'error': False})
+        self.configuration.san_is_local = True
+        driver = self._create_driver()
+        run_ssh = self.mock_object(driver, '_run_ssh')
+        execute = mock.Mock()
+        driver.set_execute(execute)
+        replayer = zol.TraceReplayer(self.trace_file.name)
+
+        summary = replayer.replay(driver)
+
+        self.assertEqual([0, 0], summary['failover_host'][2:])
+        self.assertEqual([1, 0], summary['create_snapshot'][2:])
+        # The snapshot was taken on the secondary.
+        self.assertFalse(any(replayer._commands.values()))
+        self.assertFalse(run_ssh.called)
+        self.assertFalse(execute.called)
+
+
+    def test_replay_create_volume(self):
+        recording = self._create_driver()
+        recording._stats = {'pools': [{'encryption_support': False}]}
+        self._write_trace(
+            {'t': 'cmd', 'via': 'execute', 'exit': 0,
+             'argv': (['zfs', 'create', '-V1g'] + recording._zvol_options() +
+                      ['tank/cinder/volume-a'])},
+            {'t': 'op', 'id': '1', 'op': 'create_volume',
+             'args': [{'name': 'volume-a', 'name_id': 'a', 'size': 1}],
+             'kwargs': {}, 'commands': 1, 'error': False})
+        driver = self._create_driver()
+        replayer = zol.TraceReplayer(self.trace_file.name)
+
+        summary = replayer.replay(driver)
+
+        # Without recorded output, the stats are made up.
+        self.assertFalse(driver._stats['pools'][0]['encryption_support'])
+        self.assertEqual([1, 0], summary['create_volume'][2:])
+        self.assertFalse(any(replayer._commands.values()))
+
+
+class ZFSonLinuxWarmPoolTestCase(ZFSonLinuxTestCase):
+    def _configure(self):
+        self.configuration.zol_warm_pool_sizes = ['1']
+        self.configuration.zol_warm_pool_depth = 1
+
+    def setUp(self):
+        super(ZFSonLinuxWarmPoolTestCase, self).setUp()
+        self.driver._stats = {'pools': [{'encryption_support': False}]}
+        self.mock_object(self.driver, '_is_replicated', return_value=False)
+
+        self.execute = mock.Mock(return_value=('', ''))
+        self.driver.set_execute(self.execute)
+        self.spare = 'tank/cinder/.warm/spare-a'
+
+    def _profile(self):
+        opts = ' '.join(self.driver._zvol_options())
+        return hashlib.sha1(opts).hexdigest()[:12]
+
+    def test_create_volume_from_spare(self):
+        self.driver._warm_spares = {1: [self.spare]}
+
+        self.driver.create_volume({'name': 'volume-a', 'name_id': 'a',
+                                   'size': 2})
+
+        self.assertEqual([
+            mock.call('zfs', 'rename', self.spare, 'tank/cinder/volume-a',
+                      run_as_root=True, check_exit_code=True),
+            mock.call('zfs', 'inherit', zol.ZFSonLinuxISCSIDriver.
+                      WARM_PROFILE_PROPERTY, 'tank/cinder/volume-a',
+                      run_as_root=True, check_exit_code=True),
+            mock.call('zfs', 'set', 'volsize=2G', 'tank/cinder/volume-a',
+                      run_as_root=True, check_exit_code=True)],
+            self.execute.call_args_list)
+
+    def test_spares_are_shared_when_exported(self):
+        self.driver._last_create = 0
+        self.driver._fill_warm_pool()
+
+        create = [call for call in self.execute.call_args_list
+                  if call[0][1] == 'create' and '-V1g' in call[0]]
+        self.assertEqual(1, len(create))
+        self.assertFalse([arg for arg in create[0][0] if 'shareiscsi' in arg])
+        spare = create[0][0][-1]
+
+        self.execute.reset_mock()
+        self.mock_object(self.driver, '_find_target',
+                         return_value='iqn.2010-10.org.openstack:volume-a')
+        self.driver.create_volume({'name': 'volume-a', 'name_id': 'a',
+                                   'size': 1})
+        self.driver.create_export(None, {'name': 'volume-a', 'name_id': 'a'})
+
+        self.assertEqual([
+            mock.call('zfs', 'rename', spare, 'tank/cinder/volume-a',
+                      run_as_root=True, check_exit_code=True),
+            mock.call('zfs', 'inherit', zol.ZFSonLinuxISCSIDriver.
+                      WARM_PROFILE_PROPERTY, 'tank/cinder/volume-a',
+                      run_as_root=True, check_exit_code=True),
+            mock.call('zfs', 'set', 'shareiscsi=on', 'tank/cinder/volume-a',
+                      run_as_root=True)],
+            self.execute.call_args_list)
+
+    def test_fill_warm_pool_skips_taken_spares(self):
+        self.driver._warm_spares = {1: [self.spare]}
+        self.driver._last_create = time.time()
+
+        def execute(*cmd, **kwargs):
+            if cmd[1] == 'list':
+                # Taken while being listed.
+                self.driver._create_volume_from_spare(
+                    {'name': 'volume-a', 'size': 1}, 'tank/cinder/volume-a')
+                return ('%s\t%d\t%s\n' % (self.spare, units.Gi,
+                                          self._profile()), '')
+            return ('', '')
+        self.execute.side_effect = execute
+
+        self.driver._fill_warm_pool()
+        self.assertEqual({}, self.driver._warm_spares)
+        self.assertEqual(set([self.spare]), self.driver._warm_taken)
+
+        self.execute.side_effect = None
+        self.driver._fill_warm_pool()
+        self.assertEqual(set(), self.driver._warm_taken)
+
+    def test_fill_warm_pool_failed_over(self):
+        self.driver._active_backend_id = 'dr'
+
+        self.driver._fill_warm_pool()
+
+        self.assertFalse(self.execute.called)
+
+    def test_fill_warm_pool_creates_namespace_over_ssh(self):
+        self.driver.run_local = False
+
+        def run_ssh(command, check_exit_code):
+            if ' list ' in command and check_exit_code:
+                raise processutils.ProcessExecutionError(
+                    exit_code=1, stderr='dataset does not exist')
+            return ('', '')
+        run_ssh = self.mock_object(self.driver, '_run_ssh',
+                                   side_effect=run_ssh)
+
+        self.driver._fill_warm_pool()
+
+        run_ssh.assert_any_call('zfs create -o canmount=off -o shareiscsi=off '
+                                'tank/cinder/.warm', True)
@@ -27,25 +27,47 @@ with modifications to make it work well with Cinder and OpenStack Mitaka and New
 My setup is utilizing remotly stored ZFS volumes so local access was not tested.
 """
 
+import collections
+import contextlib
+import functools
+import getopt
+import hashlib
+import json
+import math
 import os
 import socket
+import sys
+import threading
 import time
 
+from eventlet import greenpool
+from oslo_concurrency import lockutils
 from oslo_concurrency import processutils
 from oslo_config import cfg
+from oslo_utils import excutils
 from oslo_utils import importutils
+from oslo_utils import units
+from oslo_utils import uuidutils
 from oslo_log import log as logging
+from oslo_service import loopingcall
 
+from cinder import context as cinder_context
 from cinder import exception
 from cinder import interface
 from cinder import objects
+from cinder import ssh_utils
 from cinder import utils
-from cinder.i18n import _, _LE, _LI
+from cinder.i18n import _, _LE, _LI, _LW
 from cinder.volume import driver
+from cinder.volume import utils as volume_utils
+from cinder.volume import volume_types
 from cinder.volume.targets import iscsi
 from cinder.volume.drivers.san import san
 from cinder.image import image_utils
 
+libzfs_core = importutils.try_import('libzfs_core')
+zfs_exceptions = importutils.try_import('libzfs_core.exceptions')
+
 LOG = logging.getLogger(__name__)
 
 san_opts = [
@@ -96,12 +118,603 @@ san_opts = [
                default='off',
                choices=['on', 'off', 'aes-128-ccm', 'aes-192-ccm', 'aes-256-ccm',
                         'aes-128-gcm', 'aes-192-gcm', 'aes-256-gcm'],
-               help='Encryption value for new ZFS volumes.')
+               help='Encryption value for new ZFS volumes.'),
+    cfg.IntOpt('zol_replication_interval',
+               default=300,
+               help='Seconds between replication snapshots shipped to the '
+                    'replication_device.'),
+    cfg.IntOpt('zol_replication_concurrency',
+               default=4,
+               help='Number of volumes replicated at the same time.'),
+    cfg.IntOpt('zol_replication_keep',
+               default=3,
+               help='Number of replication snapshots kept per volume, on '
+                    'both the primary and the secondary host.'),
+    cfg.StrOpt('zol_replication_helper',
+               default='zol-replicate',
+               help='The replication helper (zol-replicate) on the ZFS '
+                    'hosts, which sends snapshots to and runs zfs on the '
+                    'other host.'),
+    cfg.StrOpt('zol_local_backend',
+               default='cli',
+               choices=['cli', 'libzfs_core'],
+               help='How to talk to ZFS when running locally (san_is_local). '
+                    'libzfs_core needs pyzfs and access to /dev/zfs, and '
+                    'falls back to the ZFS command for anything it can\'t '
+                    'do in-process.'),
+    cfg.StrOpt('zol_trace_file',
+               default=None,
+               help='If set, append a record of every command run by the '
+                    'driver (and the driver operation it was run for) to '
+                    'this file.'),
+    cfg.BoolOpt('zol_trace_output',
+                default=False,
+                help='Also record the output of the traced commands, which '
+                     'is needed to replay operations that parse it.'),
+    cfg.ListOpt('zol_warm_pool_sizes',
+                default=[],
+                help='Sizes (in GB) of the spare volumes kept ready in the '
+                     'warm pool, for create_volume to rename instead of '
+                     'creating a new volume.'),
+    cfg.IntOpt('zol_warm_pool_depth',
+               default=2,
+               help='Number of spare volumes kept of each warm pool size.'),
+    cfg.StrOpt('zol_warm_pool_namespace',
+               default='.warm',
+               help='Filesystem below san_zfs_volume_base where the warm '
+                    'pool spare volumes are kept.'),
+    cfg.IntOpt('zol_warm_pool_interval',
+               default=60,
+               help='Seconds between refilling the warm pool.'),
+    cfg.IntOpt('zol_warm_pool_idle',
+               default=30,
+               help='Only create spare volumes when no volume has been '
+                    'created for this many seconds.')
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(san_opts)
 
+# Index values of the 'san_zfs_*' property choices, as libzfs_core
+# (unlike the zfs command) only takes the numeric value of these.
+ZFS_PROP_INDEX = {
+    'compression': {'on': 1, 'off': 2, 'lzjb': 3, 'gzip': 10, 'gzip-1': 5,
+                    'gzip-2': 6, 'gzip-3': 7, 'gzip-4': 8, 'gzip-5': 9,
+                    'gzip-6': 10, 'gzip-7': 11, 'gzip-8': 12, 'gzip-9': 13,
+                    'zle': 14, 'lz4': 15},
+    'checksum': {'on': 1, 'off': 2, 'fletcher2': 6, 'fletcher4': 7,
+                 'sha256': 8},
+    'dedup': {'on': 1, 'off': 2, 'sha256': 8, 'verify': 257,
+              'sha256,verify': 264, 'sha256, verify': 264},
+    'sync': {'standard': 0, 'always': 1, 'disabled': 2},
+}
+ZFS_PROP_NUMERIC = ('volsize', 'volblocksize', 'copies', 'used', 'available',
+                    'referenced', 'creation', 'createtxg')
+
+
+class LibZFSCoreExecutor(object):
+    """Run ZFS commands in-process through libzfs_core (pyzfs).
+
+    Takes the same arguments as the zfs command, so it can be used
+    behind _execute. Commands (or options) it doesn't handle return
+    None, and should be run with the zfs command instead.
+    """
+
+    def __call__(self, *cmd, **kwargs):
+        if len(cmd) < 2 or cmd[0] != CONF.san_zfs_command:
+            return None
+
+        handler = getattr(self, '_zfs_' + cmd[1], None)
+        if handler is None:
+            return None
+
+        try:
+            return handler(*cmd[2:])
+        except getopt.GetoptError:
+            # An option we don't know about.
+            return None
+        except zfs_exceptions.ZFSError as exc:
+            LOG.debug('libzfs_core: %s failed: %s', ' '.join(cmd), exc)
+            if kwargs.get('check_exit_code', True) is False:
+                return ('', str(exc))
+            raise processutils.ProcessExecutionError(
+                exit_code=1, stderr=str(exc), cmd=' '.join(cmd))
+
+    def _supported(self, *funcs):
+        return all(libzfs_core.is_supported(func) for func in funcs)
+
+    def _zfs_create(self, *args):
+        opts, args = getopt.getopt(args, 'sV:o:')
+        opts_dict = dict(opts)
+        if len(args) != 1 or '-V' not in opts_dict or '-s' not in opts_dict:
+            # Only (sparse) volumes, the reservation of a thick
+            # volume is calculated by libzfs.
+            return None
+
+        size = opts_dict['-V'].lower()
+        if not size.endswith('g'):
+            return None
+        props = {'volsize': int(size[:-1]) * units.Gi}
+        for opt, value in opts:
+            if opt != '-o':
+                continue
+            prop, value = value.split('=', 1)
+            if prop in ZFS_PROP_INDEX and value in ZFS_PROP_INDEX[prop]:
+                props[prop] = ZFS_PROP_INDEX[prop][value]
+            elif prop in ZFS_PROP_NUMERIC:
+                props[prop] = int(value)
+            elif ':' in prop:
+                # User property.
+                props[prop] = value
+            elif prop == 'encryption' and value == 'off':
+                continue
+            else:
+                return None
+
+        libzfs_core.lzc_create(args[0], ds_type='zvol', props=props)
+        return ('', '')
+
+    def _zfs_snapshot(self, *args):
+        if len(args) != 1:
+            return None
+        libzfs_core.lzc_snapshot([args[0]])
+        return ('', '')
+
+    def _zfs_clone(self, *args):
+        if len(args) != 2:
+            return None
+        libzfs_core.lzc_clone(args[1], args[0])
+        return ('', '')
+
+    def _zfs_promote(self, *args):
+        if len(args) != 1 or not self._supported(libzfs_core.lzc_promote):
+            return None
+        libzfs_core.lzc_promote(args[0])
+        return ('', '')
+
+    def _zfs_rollback(self, *args):
+        if len(args) != 1 or '@' not in args[0]:
+            return None
+        libzfs_core.lzc_rollback_to(args[0].split('@')[0], args[0])
+        return ('', '')
+
+    def _zfs_rename(self, *args):
+        if len(args) != 2 or '@' in args[0] or \
+                not self._supported(libzfs_core.lzc_rename):
+            return None
+        libzfs_core.lzc_rename(args[0], args[1])
+        return ('', '')
+
+    def _zfs_destroy(self, *args):
+        if len(args) != 1:
+            return None
+
+        if '@' in args[0]:
+            # Also handle 'volume@snap1,snap2,...'.
+            name, snaps = args[0].split('@', 1)
+            libzfs_core.lzc_destroy_snaps(
+                ['%s@%s' % (name, snap) for snap in snaps.split(',')],
+                defer=False)
+        elif self._supported(libzfs_core.lzc_destroy):
+            libzfs_core.lzc_destroy(args[0])
+        else:
+            return None
+        return ('', '')
+
+    def _zfs_set(self, *args):
+        if len(args) != 2 or not self._supported(libzfs_core.lzc_set_prop):
+            return None
+
+        prop, value = args[0].split('=', 1)
+        if prop == 'volsize' and value.upper().endswith('G'):
+            # Only sparse volumes, the zfs command also grows the
+            # refreservation of a thick volume.
+            if not self._supported(libzfs_core.lzc_get_props) or \
+                    libzfs_core.lzc_get_props(args[1]).get(
+                        'refreservation', 0):
+                return None
+            value = int(value[:-1]) * units.Gi
+        elif prop in ZFS_PROP_INDEX and value in ZFS_PROP_INDEX[prop]:
+            value = ZFS_PROP_INDEX[prop][value]
+        elif ':' not in prop:
+            return None
+
+        libzfs_core.lzc_set_prop(args[1], prop, value)
+        return ('', '')
+
+    def _get_props(self, name):
+        props = libzfs_core.lzc_get_props(name)
+        if '@' in name:
+            props['type'] = 'snapshot'
+        elif 'volsize' in props:
+            props['type'] = 'volume'
+        else:
+            props['type'] = 'filesystem'
+        props['name'] = name
+        return props
+
+    def _zfs_get(self, *args):
+        opts, args = getopt.getopt(args, 'Hpo:')
+        if len(args) != 2 or ('-o', 'value') not in opts or \
+                args[0] not in ZFS_PROP_NUMERIC or \
+                not self._supported(libzfs_core.lzc_get_props):
+            return None
+
+        props = self._get_props(args[1])
+        if args[0] not in props:
+            return None
+        return ('%s\n' % props[args[0]], '')
+
+    def _walk(self, name, recursive, types):
+        """Yield the properties of 'name' and, if recursive, its children."""
+        props = self._get_props(name)
+        if props['type'] in types:
+            yield props
+        if not recursive:
+            return
+
+        if 'snapshot' in types and props['type'] != 'snapshot':
+            for snap in sorted(libzfs_core.lzc_list_snaps(name)):
+                yield self._get_props(snap)
+        for child in sorted(libzfs_core.lzc_list_children(name)):
+            for child_props in self._walk(child, recursive, types):
+                yield child_props
+
+    def _zfs_list(self, *args):
+        opts, args = getopt.getopt(args, 'Hprt:o:')
+        opts_dict = dict(opts)
+        if len(args) != 1 or '-H' not in opts_dict:
+            return None
+
+        columns = opts_dict.get('-o', 'name').split(',')
+        for column in columns:
+            if column in ZFS_PROP_NUMERIC and '-p' not in opts_dict:
+                # Would have to be human readable.
+                return None
+            if column not in ('name', 'type') + ZFS_PROP_NUMERIC and \
+                    ':' not in column:
+                return None
+
+        if '-r' in opts_dict:
+            if not self._supported(libzfs_core.lzc_get_props,
+                                   libzfs_core.lzc_list_children,
+                                   libzfs_core.lzc_list_snaps):
+                return None
+        elif columns == ['name']:
+            # Only checking if it exists.
+            if not libzfs_core.lzc_exists(args[0]):
+                raise processutils.ProcessExecutionError(
+                    exit_code=1, cmd='zfs list',
+                    stderr="cannot open '%s': dataset does not exist"
+                    % args[0])
+            return ('%s\n' % args[0], '')
+        elif not self._supported(libzfs_core.lzc_get_props):
+            return None
+
+        types = opts_dict.get('-t', 'filesystem,volume').split(',')
+        lines = []
+        for props in self._walk(args[0], '-r' in opts_dict, types):
+            lines.append('\t'.join(str(props.get(column, '-'))
+                                   for column in columns))
+        return (''.join(line + '\n' for line in lines), '')
+
+
+# Keys of volumes, snapshots and references recorded in the trace file.
+TRACE_KEYS = ('id', 'name', 'name_id', 'size', 'volume_id', 'volume_name',
+              'volume_size', 'volume_type_id', 'source-name')
+
+
+def _trace_value(value):
+    """Reduce a driver operation argument to something JSON can record.
+
+    Volumes, snapshots and other dict like arguments are reduced to
+    their TRACE_KEYS, and anything else (contexts, image services etc)
+    is recorded as None.
+    """
+    if value is None or isinstance(value, (basestring, int, long, float)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_trace_value(item) for item in value]
+    if hasattr(value, '__getitem__'):
+        picked = {}
+        for key in TRACE_KEYS:
+            try:
+                item = value[key]
+            except Exception:
+                continue
+            if item is None or isinstance(item, (basestring, int, long)):
+                picked[key] = item
+        return picked or None
+    return None
+
+
+def _exit_code_checked(check_exit_code, exit_code):
+    """Whether 'exit_code' is an error, as processutils.execute() decides
+    it for a 'check_exit_code' of True/False, an exit code or a list
+    of them (and None, which is what _run_ssh() takes for False).
+    """
+    if check_exit_code is None or isinstance(check_exit_code, bool):
+        return bool(check_exit_code) and exit_code != 0
+    if isinstance(check_exit_code, int):
+        check_exit_code = [check_exit_code]
+    return exit_code not in check_exit_code
+
+
+def traced(func):
+    """Group the commands run by a driver operation in the trace file."""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        tracer = getattr(self, '_tracer', None)
+        if not tracer:
+            return func(self, *args, **kwargs)
+        with tracer.operation(func.__name__, args, kwargs):
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+class CommandTracer(object):
+    """Append-only recorder of the commands run by the driver.
+
+    Every line in the trace file is a JSON record, either of a command
+    ('t': 'cmd') or of the driver operation ('t': 'op') that the
+    commands with the same 'op' id were run for. The operation record
+    is written when the operation is done, after its commands.
+    """
+
+    def __init__(self, path, capture_output=False):
+        self._file = open(path, 'a', 1)
+        self._capture_output = capture_output
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._op_prefix = '%d.%d' % (os.getpid(), int(time.time()))
+        self._op_count = 0
+        self._op_commands = {}
+
+    def _write(self, record):
+        line = json.dumps(record, separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + '\n')
+
+    @contextlib.contextmanager
+    def operation(self, name, args, kwargs):
+        if getattr(self._local, 'op', None):
+            # Part of an operation that is already traced.
+            yield
+            return
+
+        with self._lock:
+            self._op_count += 1
+            op_id = '%s.%d' % (self._op_prefix, self._op_count)
+            self._op_commands[op_id] = 0
+        self._local.op = op_id
+
+        start = time.time()
+        error = False
+        try:
+            yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            self._local.op = None
+            with self._lock:
+                commands = self._op_commands.pop(op_id)
+            self._write({'t': 'op', 'id': op_id, 'op': name,
+                         'args': _trace_value(args),
+                         'kwargs': dict((key, _trace_value(value))
+                                        for key, value in kwargs.items()),
+                         'start': round(start, 6),
+                         'elapsed': round(time.time() - start, 6),
+                         'commands': commands,
+                         'error': error})
+
+    def bind(self, func):
+        """Make 'func' part of the current operation, in any thread."""
+        op_id = getattr(self._local, 'op', None)
+
+        def bound(*args, **kwargs):
+            self._local.op = op_id
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.op = None
+        return bound
+
+    def call(self, via, func, cmd, kwargs, check_exit_code=True):
+        """Run func(*cmd, **kwargs) and record it.
+
+        The command is always run with check_exit_code=True, so that
+        its real exit status is recorded. What the caller asked for (or
+        'check_exit_code' if it didn't ask) is then applied here.
+        """
+        wanted = kwargs.get('check_exit_code', check_exit_code)
+        kwargs = dict(kwargs, check_exit_code=True)
+        exit_code = 0
+        out = err = ''
+        start = time.time()
+        try:
+            result = func(*cmd, **kwargs)
+            if isinstance(result, tuple) and len(result) == 2:
+                out, err = result
+            return result
+        except processutils.ProcessExecutionError as exc:
+            exit_code = exc.exit_code
+            out, err = exc.stdout, exc.stderr
+            if _exit_code_checked(wanted, exit_code):
+                raise
+            return (out, err)
+        except Exception:
+            exit_code = None
+            raise
+        finally:
+            op_id = getattr(self._local, 'op', None)
+            if op_id:
+                with self._lock:
+                    self._op_commands[op_id] += 1
+            record = {'t': 'cmd', 'op': op_id, 'via': via,
+                      'argv': [str(arg) for arg in cmd],
+                      'start': round(start, 6),
+                      'elapsed': round(time.time() - start, 6),
+                      'exit': exit_code,
+                      'out': len(out or ''), 'err': len(err or '')}
+            if self._capture_output:
+                record['stdout'] = out or ''
+                record['stderr'] = err or ''
+            self._write(record)
+
+
+class TraceReplayer(object):
+    """Simulated ZFS/iSCSI backend replaying a trace file.
+
+    Commands are answered with the recorded exit status (and output, if
+    it was recorded with 'zol_trace_output') after sleeping the recorded
+    time divided by 'speed'. Commands that weren't recorded succeed
+    immediately without output.
+    """
+
+    # Operations that read or write local devices, which aren't simulated.
+    SKIPPED_OPERATIONS = ('copy_image_to_volume', 'copy_volume_to_image')
+
+    def __init__(self, path, speed=1.0):
+        self.speed = speed
+        self.replayed_commands = 0
+        self.operations = []
+        self._commands = collections.defaultdict(collections.deque)
+        with open(path) as trace:
+            for line in trace:
+                record = json.loads(line)
+                if record['t'] != 'op':
+                    key = self._key(record['via'], record['argv'])
+                    self._commands[key].append(record)
+                elif record['op'] not in self.SKIPPED_OPERATIONS:
+                    self.operations.append(record)
+        self.operations.sort(key=lambda op: op['start'])
+
+    @staticmethod
+    def _key(via, cmd):
+        return (via, tuple(str(arg) for arg in cmd))
+
+    def _replay(self, via, cmd, kwargs, check_exit_code=True):
+        self.replayed_commands += 1
+        queue = self._commands.get(self._key(via, cmd))
+        if not queue:
+            return ('', '')
+
+        record = queue.popleft()
+        time.sleep(record['elapsed'] / self.speed)
+        out = record.get('stdout', '')
+        err = record.get('stderr', '')
+        if record['exit'] is None:
+            raise processutils.ProcessExecutionError(
+                stderr=err, cmd=' '.join(record['argv']))
+        if _exit_code_checked(kwargs.get('check_exit_code', check_exit_code),
+                              record['exit']):
+            raise processutils.ProcessExecutionError(
+                exit_code=record['exit'], stdout=out, stderr=err,
+                cmd=' '.join(record['argv']))
+        return (out, err)
+
+    def host_execute(self, *cmd, **kwargs):
+        return self._replay('host', cmd, kwargs)
+
+    @staticmethod
+    def summarize(results):
+        """Total count, time, commands and errors per operation name."""
+        summary = {}
+        for name, elapsed, commands, error in results:
+            totals = summary.setdefault(name, [0, 0.0, 0, 0])
+            totals[0] += 1
+            totals[1] += elapsed
+            totals[2] += commands
+            totals[3] += int(error)
+        return summary
+
+    def recorded(self):
+        return self.summarize((op['op'], op['elapsed'], op['commands'],
+                               op['error']) for op in self.operations)
+
+    def replay(self, driver):
+        """Run the traced operations against 'driver' on this backend.
+
+        Returns the summary of the replayed operations, comparable with
+        recorded().
+        """
+        # Every ZFS command goes here, locally or over SSH (even after a
+        # replayed failover_host), and whatever the local backend is.
+        # Exit codes are checked by default locally, but not over SSH.
+        driver._tracer = None
+        driver._run_execute = lambda *cmd, **kwargs: self._replay(
+            'execute', cmd, kwargs, check_exit_code=driver.run_local)
+        driver.set_host_execute(self.host_execute)
+
+        # The volume manager gets the stats before anything else, and
+        # create_volume needs them. From the recorded output if there
+        # is any, or as if nothing was supported.
+        try:
+            driver._update_volume_stats()
+        except Exception as exc:
+            LOG.debug('replay: no volume stats: %s', exc)
+            driver._stats = {'pools': [{'encryption_support': False}]}
+
+        results = []
+        for op in self.operations:
+            commands = self.replayed_commands
+            error = False
+            start = time.time()
+            try:
+                getattr(driver, op['op'])(*op['args'], **op['kwargs'])
+            except Exception as exc:
+                LOG.debug('replay: %s failed: %s', op['op'], exc)
+                error = True
+            results.append((op['op'], time.time() - start,
+                            self.replayed_commands - commands, error))
+
+        return self.summarize(results)
+
+
+def main(argv=None):
+    """Replay a trace file against this version of the driver.
+
+    Usage: zol.py <trace file> <backend section> [<speed>] [-- <cinder options>]
+
+    Prints, per operation, the recorded and the replayed count, total
+    time, number of commands and errors.
+    """
+    from cinder.volume import configuration
+
+    argv = list(sys.argv[1:] if argv is None else argv)
+    cinder_args = []
+    if '--' in argv:
+        cinder_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    if len(argv) < 2:
+        print(main.__doc__)
+        return 1
+
+    CONF(cinder_args, project='cinder')
+    replayer = TraceReplayer(argv[0],
+                             float(argv[2]) if len(argv) > 2 else 1.0)
+    config = configuration.Configuration(driver.volume_opts,
+                                         config_group=argv[1])
+    config.append_config_values(san_opts)
+
+    recorded = replayer.recorded()
+    replayed = replayer.replay(ZFSonLinuxISCSIDriver(configuration=config))
+
+    line = '%-32s %8s %12s %9s %7s'
+    print(line % ('operation', 'count', 'time', 'commands', 'errors'))
+    for name in sorted(set(recorded) | set(replayed)):
+        for label, summary in (('recorded', recorded), ('replayed', replayed)):
+            count, elapsed, commands, errors = summary.get(name,
+                                                           (0, 0.0, 0, 0))
+            print(line % ('%s (%s)' % (name, label), count,
+                          '%.3f' % elapsed, commands, errors))
+    for label, summary in (('recorded', recorded), ('replayed', replayed)):
+        print('total (%s): %.3f seconds, %d commands' % (
+            label, sum(totals[1] for totals in summary.values()),
+            sum(totals[2] for totals in summary.values())))
+    return 0
+
 
 @interface.volumedriver
 class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
@@ -123,6 +736,14 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
     """
     VERSION = '2.0.0'
 
+    # User property marking the volumes to replicate, and the prefix of
+    # the snapshots shipped to the replication_device.
+    REPLICATION_PROPERTY = 'org.openstack:replication'
+    REPLICATION_PREFIX = 'replication-'
+
+    # User property with the profile (creation options) of a warm pool spare.
+    WARM_PROFILE_PROPERTY = 'org.openstack:warm-profile'
+
     _local_execute = utils.execute
 
     def _getrl(self):
@@ -141,6 +762,12 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
         super(ZFSonLinuxISCSIDriver, self).__init__(*args, **kwargs)
         self.configuration.append_config_values(san_opts)
         self.hostname = socket.gethostname()
+        self._local_host_execute = utils.execute
+
+        self._tracer = None
+        if self.configuration.zol_trace_file:
+            self._tracer = CommandTracer(self.configuration.zol_trace_file,
+                                         self.configuration.zol_trace_output)
         self.backend_name =\
             self.configuration.safe_get('volume_backend_name') or 'ZOL'
 
@@ -167,21 +794,120 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
             self.configuration.max_over_subscription_ratio = \
                 self.configuration.zol_max_over_subscription_ratio
 
+        # Warm pool spares, by size in GB.
+        self._warm_spares = {}
+        self._warm_taken = set()
+        self._warm_lock = threading.Lock()
+        self._warm_loop = None
+        self._last_create = 0
+
+        self._zfs_core = None
+        if self.configuration.zol_local_backend == 'libzfs_core':
+            if not libzfs_core:
+                LOG.warning(_LW('libzfs_core (pyzfs) is not installed, '
+                                'using the ZFS command.'))
+            elif not os.access('/dev/zfs', os.R_OK | os.W_OK):
+                LOG.warning(_LW('Cannot access /dev/zfs, using the ZFS '
+                                'command.'))
+            else:
+                self._zfs_core = LibZFSCoreExecutor()
+
+        # Only one secondary host is supported.
+        self._replication_device = None
+        if self.configuration.safe_get('replication_device'):
+            self._replication_device = self.configuration.replication_device[0]
+        self._replication_synced = {}
+        self._replication_loop = None
+
+        # Remember the primary, so that we can fail back to it.
+        self._primary_backend = {
+            'san_ip': self.configuration.san_ip,
+            'san_login': self.configuration.san_login,
+            'san_zfs_volume_base': self.configuration.san_zfs_volume_base,
+            'run_local': self.run_local,
+        }
+        self._active_backend_id = kwargs.get('active_backend_id')
+        if self._active_backend_id and self._active_backend_id != 'default':
+            self._switch_backend(self._get_replication_device(
+                self._active_backend_id))
+
         LOG.info("run local = %s (%s)" % (self.run_local, CONF.san_is_local))
 
     def do_setup(self, context):
-        pass
+        if self._replication_device:
+            self._replication_loop = loopingcall.FixedIntervalLoopingCall(
+                self._replicate_volumes)
+            self._replication_loop.start(
+                interval=self.configuration.zol_replication_interval,
+                initial_delay=self.configuration.zol_replication_interval)
+
+        if self.configuration.zol_warm_pool_sizes:
+            self._warm_loop = loopingcall.FixedIntervalLoopingCall(
+                self._fill_warm_pool)
+            self._warm_loop.start(
+                interval=self.configuration.zol_warm_pool_interval)
 
     def check_for_setup_error(self):
-        pass
+        if self._replication_device:
+            for key in ('backend_id', 'san_ip', 'san_zfs_volume_base'):
+                if not self._replication_device.get(key):
+                    raise exception.InvalidInput(
+                        reason=_('replication_device is missing %s.') % key)
 
     def set_execute(self, execute):
         LOG.debug("override local execute cmd with %s (%s)" % (
             repr(execute), execute.__module__))
         self._local_execute = execute
 
+    def set_host_execute(self, execute):
+        LOG.debug("override host execute cmd with %s (%s)" % (
+            repr(execute), execute.__module__))
+        self._local_host_execute = execute
+
+    def _host_execute(self, *cmd, **kwargs):
+        """Run a command (iscsiadm etc) on the Cinder host."""
+        if self._tracer:
+            return self._tracer.call('host', self._local_host_execute,
+                                     cmd, kwargs)
+        return self._local_host_execute(*cmd, **kwargs)
+
     def _execute(self, *cmd, **kwargs):
+        if self._tracer:
+            # Exit codes are checked by default locally, but not over SSH.
+            return self._tracer.call(
+                'execute',
+                self._run_execute if self.run_local else self._ssh_execute,
+                cmd, kwargs, check_exit_code=self.run_local)
+        return self._run_execute(*cmd, **kwargs)
+
+    def _ssh_execute(self, *cmd, **kwargs):
+        """Run a command over SSH, raising for any exit status but 0.
+
+        Used when tracing, which runs every command like this to record
+        its exit status. _run_ssh() would log an error and sleep before
+        raising for a command that isn't expected to succeed.
+        """
+        LOG.debug("SSH execute cmd: %s %s" % (cmd, kwargs))
+        utils.check_ssh_injection([str(arg) for arg in cmd])
+        if not self.sshpool:
+            config = self.configuration
+            self.sshpool = ssh_utils.SSHPool(
+                config.san_ip, config.san_ssh_port, config.ssh_conn_timeout,
+                config.san_login, password=config.san_password,
+                privatekey=config.san_private_key,
+                min_size=config.ssh_min_pool_conn,
+                max_size=config.ssh_max_pool_conn)
+        with self.sshpool.item() as ssh:
+            return processutils.ssh_execute(ssh, ' '.join(cmd),
+                                            check_exit_code=True)
+
+    def _run_execute(self, *cmd, **kwargs):
         if self.run_local:
+            if self._zfs_core:
+                result = self._zfs_core(*cmd, **kwargs)
+                if result is not None:
+                    LOG.debug("LIBZFS_CORE execute cmd: %s" % (cmd,))
+                    return result
             LOG.debug("LOCAL execute cmd: %s %s" % (cmd, kwargs))
             return self._local_execute(*cmd, **kwargs)
         else:
@@ -190,6 +916,7 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
             command = ' '.join(cmd)
             return self._run_ssh(command, check_exit_code)
 
+    @traced
     def create_snapshot(self, snapshot):
         """Creates a snapshot."""
         LOG.debug('create_snapshot(%s)', snapshot['name'])
@@ -199,6 +926,7 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
         self._execute(CONF.san_zfs_command, 'snapshot', snap_path,
                                     run_as_root=True)
 
+    @traced
     def delete_snapshot(self, snapshot):
         """Deletes a snapshot."""
         LOG.debug('delete_snapshot(%s)', snapshot['name'])
@@ -212,28 +940,660 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
         self._execute(CONF.san_zfs_command, 'destroy', snap_path,
                                     run_as_root=True)
 
+    def _zvol_options(self):
+        """Options (except the size) for creating a new zfs volume."""
+        opts = []
+        if CONF.san_thin_provision:
+            opts.append('-s')
+        if self._stats['pools'][0]['encryption_support']:
+            opts.extend(['-o', 'encryption='+CONF.san_zfs_encryption])
+        opts.extend(['-o', 'compression='+CONF.san_zfs_compression])
+        opts.extend(['-o', 'dedup='+CONF.san_zfs_dedup])
+        opts.extend(['-o', 'volblocksize='+str(CONF.san_zfs_blocksize)])
+        opts.extend(['-o', 'checksum='+CONF.san_zfs_checksum])
+        opts.extend(['-o', 'copies='+CONF.san_zfs_copies])
+        opts.extend(['-o', 'sync='+CONF.san_zfs_sync])
+        return opts
+
+    def _warm_pool_base(self):
+        return self._build_zfs_poolname(
+            self.configuration.zol_warm_pool_namespace)
+
+    def _create_volume_from_spare(self, volume, zfs_poolname):
+        """Create the volume by renaming a spare from the warm pool.
+
+        Uses the largest spare that isn't bigger than the volume, and
+        grows it if needed. Returns False if there is no such spare.
+        """
+        with self._warm_lock:
+            sizes = [size for size, spares in self._warm_spares.items()
+                     if size <= volume['size'] and spares]
+            if not sizes:
+                return False
+            spare_size = max(sizes)
+            spare = self._warm_spares[spare_size].pop()
+            # Until a refresh of the pool no longer finds it.
+            self._warm_taken.add(spare)
+
+        LOG.debug('create_volume: using warm pool spare %s', spare)
+        try:
+            self._execute(CONF.san_zfs_command, 'rename', spare,
+                          zfs_poolname, run_as_root=True,
+                          check_exit_code=True)
+        except processutils.ProcessExecutionError as exc:
+            # Possibly taken by someone else, create it the normal way.
+            LOG.warning(_LW('Cannot rename warm pool spare %(spare)s: '
+                            '%(err)s'), {'spare': spare, 'err': exc.stderr})
+            with self._warm_lock:
+                self._warm_taken.discard(spare)
+            return False
+
+        # It's not a spare anymore.
+        self._execute(CONF.san_zfs_command, 'inherit',
+                      self.WARM_PROFILE_PROPERTY, zfs_poolname,
+                      run_as_root=True, check_exit_code=True)
+        if spare_size < volume['size']:
+            self._execute(CONF.san_zfs_command, 'set',
+                          'volsize=' + self._sizestr(volume['size']),
+                          zfs_poolname, run_as_root=True,
+                          check_exit_code=True)
+        return True
+
+    @traced
+    def _fill_warm_pool(self):
+        """Top up the warm pool with spare volumes.
+
+        Called every 'zol_warm_pool_interval' seconds. The list of spares
+        is always refreshed, but new ones are only created as long as no
+        volume has been created in the last 'zol_warm_pool_idle' seconds.
+        """
+        if not self._stats.get('pools'):
+            # The creation options depends on the stats.
+            return
+        if self._active_backend_id not in (None, 'default'):
+            # Don't fill up the secondary.
+            return
+
+        base = self._warm_pool_base()
+        opts = self._zvol_options()
+        profile = hashlib.sha1(' '.join(opts)).hexdigest()[:12]
+        try:
+            try:
+                spares = self._list_datasets(
+                    base, types='volume',
+                    props=('name', 'volsize', self.WARM_PROFILE_PROPERTY))
+            except processutils.ProcessExecutionError:
+                LOG.info(_LI('Creating warm pool filesystem %s'), base)
+                # Spares aren't iSCSI targets until they are exported,
+                # renamed to a volume that inherits shareiscsi again.
+                self._execute(CONF.san_zfs_command, 'create',
+                              '-o', 'canmount=off', '-o', 'shareiscsi=off',
+                              base, run_as_root=True, check_exit_code=True)
+                spares = []
+
+            # Spares taken by create_volume while they were listed are
+            # of no use, and neither are those created with other options.
+            with self._warm_lock:
+                taken = set(self._warm_taken)
+            inventory = {}
+            for spare in spares:
+                if spare['name'] in taken:
+                    continue
+                if spare[self.WARM_PROFILE_PROPERTY] != profile:
+                    self._execute(CONF.san_zfs_command, 'destroy',
+                                  spare['name'], run_as_root=True,
+                                  check_exit_code=False)
+                    continue
+                inventory.setdefault(self._size_in_gb(spare['volsize']),
+                                     []).append(spare['name'])
+            with self._warm_lock:
+                for size in inventory:
+                    inventory[size] = [name for name in inventory[size]
+                                       if name not in self._warm_taken]
+                self._warm_spares = inventory
+                # Those not listed anymore have been renamed.
+                self._warm_taken &= set(spare['name'] for spare in spares)
+
+            for size in self.configuration.zol_warm_pool_sizes:
+                size = int(size)
+                while len(self._warm_spares.get(size, [])) < \
+                        self.configuration.zol_warm_pool_depth:
+                    if time.time() - self._last_create < \
+                            self.configuration.zol_warm_pool_idle:
+                        LOG.debug('Volumes are being created, not filling '
+                                  'the warm pool')
+                        return
+
+                    spare = '%s/spare-%s' % (base, uuidutils.generate_uuid())
+                    cmd = [CONF.san_zfs_command, 'create', '-V%sg' % size]
+                    cmd.extend(opts)
+                    cmd.extend(['-o', '%s=%s' % (self.WARM_PROFILE_PROPERTY,
+                                                 profile),
+                                spare])
+                    self._execute(*cmd, run_as_root=True,
+                                  check_exit_code=True)
+                    with self._warm_lock:
+                        self._warm_spares.setdefault(size, []).append(spare)
+        except Exception:
+            # Don't let a failure stop the looping call.
+            LOG.exception(_LE('Error filling the warm pool'))
+
+    @traced
     def create_volume(self, volume):
         zfs_poolname = self._build_zfs_poolname(volume['name'])
         LOG.debug('create_volume(%s) => %s', volume['name_id'], zfs_poolname)
 
+        self._last_create = time.time()
+        replicated = self._is_replicated(volume)
+        if not replicated and self._create_volume_from_spare(volume,
+                                                             zfs_poolname):
+            return
+
         # Create a zfs volume
-        cmd = [CONF.san_zfs_command, 'create']
-        if CONF.san_thin_provision:
-            cmd.append('-s')
-        cmd.extend(['-V%sg' % volume['size']])
-        if self._stats['pools'][0]['encryption_support']:
-            cmd.extend(['-o', 'encryption='+CONF.san_zfs_encryption])
-        cmd.extend(['-o', 'compression='+CONF.san_zfs_compression])
-        cmd.extend(['-o', 'dedup='+CONF.san_zfs_dedup])
-        cmd.extend(['-o', 'volblocksize='+str(CONF.san_zfs_blocksize)])
-        cmd.extend(['-o', 'checksum='+CONF.san_zfs_checksum])
-        cmd.extend(['-o', 'copies='+CONF.san_zfs_copies])
-        cmd.extend(['-o', 'sync='+CONF.san_zfs_sync])
+        cmd = [CONF.san_zfs_command, 'create', '-V%sg' % volume['size']]
+        cmd.extend(self._zvol_options())
+        if replicated:
+            cmd.extend(['-o', self.REPLICATION_PROPERTY + '=on'])
         cmd.append(zfs_poolname)
 
         LOG.debug('About to run command: "%s"', *cmd)
         self._execute(*cmd, run_as_root=True)
 
+        if replicated:
+            return {'replication_status': 'enabled'}
+
+    def snapshot_revert_use_temp_snapshot(self):
+        # The rollback is atomic, so the manager doesn't need to take a
+        # temporary snapshot first. Being a Cinder snapshot newer than
+        # the one reverted to, it would only make the revert fail.
+        return False
+
+    @traced
+    def revert_to_snapshot(self, context, volume, snapshot):
+        """Revert volume to snapshot using 'zfs rollback'.
+
+        Any newer snapshots are destroyed by the rollback, so refuse if
+        one of them is known to Cinder or has clones depending on it.
+        """
+        LOG.debug('revert_to_snapshot(%s, %s)', volume['name'],
+                  snapshot['name'])
+
+        with self._volume_lock(volume['name']):
+            self._revert_locked_volume(volume, snapshot)
+
+    def _revert_locked_volume(self, volume, snapshot):
+        zfs_poolname = self._build_zfs_poolname(volume['name'])
+        snap_path = "%s@%s" % (zfs_poolname, snapshot['name'])
+
+        # CMD: zfs list -Hpr -t snapshot -o name,createtxg,clones share/cinder/volume-...
+        snapshots = self._list_datasets(zfs_poolname, types='snapshot',
+                                        props=('name', 'createtxg', 'clones'))
+        snapshots.sort(key=lambda snap: int(snap['createtxg']))
+        names = [snap['name'] for snap in snapshots]
+        if snap_path not in names:
+            raise exception.InvalidSnapshot(
+                reason=_('Snapshot %s not found on the ZFS host.') % snap_path)
+
+        newer = snapshots[names.index(snap_path) + 1:]
+        for snap in newer:
+            if snap['clones'] not in ('', '-'):
+                msg = (_("Cannot revert to %(snap)s, newer snapshot %(newer)s "
+                         "has clones: %(clones)s")
+                       % {'snap': snap_path, 'newer': snap['name'],
+                          'clones': snap['clones']})
+                raise exception.VolumeBackendAPIException(data=msg)
+            if self._extract_cinder_id(snap['name'].split('@')[1],
+                                       CONF.snapshot_name_template):
+                msg = (_("Cannot revert to %(snap)s, newer snapshot %(newer)s "
+                         "is managed by Cinder")
+                       % {'snap': snap_path, 'newer': snap['name']})
+                raise exception.VolumeBackendAPIException(data=msg)
+
+        # Make sure no iSCSI session is writing to the volume while it's
+        # being rolled back. If it isn't exported, there's no target.
+        target = self._find_target(volume['name_id'])
+        if target and self._get_iscsi_sessions(target):
+            if not self._logout_target(self.configuration.san_ip + ':' +
+                                       str(self.configuration.iscsi_port),
+                                       target):
+                msg = _('Cannot logout iSCSI sessions, cannot revert '
+                        'volume %s') % volume['name']
+                raise exception.VolumeBackendAPIException(data=msg)
+
+        cmd = [CONF.san_zfs_command, 'rollback']
+        if newer:
+            LOG.info(_LI('revert_to_snapshot: destroying newer snapshots %s'),
+                     ', '.join(snap['name'] for snap in newer))
+            cmd.append('-r')
+        cmd.append(snap_path)
+        self._execute(*cmd, run_as_root=True, check_exit_code=True)
+
+        # Replication snapshots destroyed by the rollback are still on the
+        # secondary. Roll it back as well, so the next incremental send
+        # has a common snapshot to start from.
+        if self._replication_device and \
+                any(snap['name'].split('@')[1].startswith(
+                    self.REPLICATION_PREFIX) for snap in newer):
+            self._replication_synced.pop(volume['name'], None)
+            kept = [snap['name'].split('@')[1]
+                    for snap in snapshots[:names.index(snap_path) + 1]
+                    if snap['name'].split('@')[1].startswith(
+                        self.REPLICATION_PREFIX)]
+            if kept:
+                try:
+                    self._secondary_zfs('rollback', '-r', '%s@%s' % (
+                        self._secondary_name(volume['name']), kept[-1]),
+                        check_exit_code=True)
+                except processutils.ProcessExecutionError as exc:
+                    # The volume itself is reverted, so don't fail.
+                    LOG.error(_LE('Cannot roll back the replica of %(vol)s '
+                                  'to %(snap)s: %(err)s'),
+                              {'vol': volume['name'], 'snap': kept[-1],
+                               'err': exc.stderr})
+
+        # The rollback also reverts volsize, but the volume keeps its
+        # current size in Cinder.
+        if volume['size'] > snapshot['volume_size']:
+            self._execute(CONF.san_zfs_command, 'set',
+                          'volsize=' + self._sizestr(volume['size']),
+                          zfs_poolname, run_as_root=True,
+                          check_exit_code=True)
+
+    def _get_replication_device(self, backend_id=None):
+        """Get the replication_device, checking its backend_id if given."""
+        device = self._replication_device
+        if not device:
+            raise exception.InvalidReplicationTarget(
+                reason=_('No replication_device configured.'))
+        if backend_id and backend_id != device['backend_id']:
+            raise exception.InvalidReplicationTarget(
+                reason=_('Unknown replication target %s.') % backend_id)
+        return device
+
+    def _is_replicated(self, volume):
+        return self._is_replicated_type(volume.get('volume_type_id'))
+
+    def _is_replicated_type(self, volume_type_id):
+        if not self._replication_device or not volume_type_id:
+            return False
+        specs = volume_types.get_volume_type_extra_specs(volume_type_id)
+        return specs.get('replication_enabled') == '<is> True'
+
+    def _set_replicated(self, zfs_poolname, replicated):
+        """Mark (or unmark) a volume for the replication."""
+        if replicated:
+            self._execute(CONF.san_zfs_command, 'set',
+                          self.REPLICATION_PROPERTY + '=on', zfs_poolname,
+                          run_as_root=True, check_exit_code=True)
+        else:
+            self._execute(CONF.san_zfs_command, 'inherit',
+                          self.REPLICATION_PROPERTY, zfs_poolname,
+                          run_as_root=True, check_exit_code=True)
+
+    def _replication_helper(self, *args, **kwargs):
+        """Run the replication helper on the active ZFS host.
+
+        It runs zfs on (or sends a snapshot to) another ZFS host, so
+        the active host needs (passwordless) SSH access to that one.
+        """
+        return self._execute(self.configuration.zol_replication_helper,
+                             *args, run_as_root=True, **kwargs)
+
+    def _remote_host(self, settings):
+        login = settings.get('san_login', self._primary_backend['san_login'])
+        return '%s@%s' % (login, settings['san_ip'])
+
+    def _remote_zfs(self, settings, *cmd, **kwargs):
+        """Run 'zfs list/rollback/destroy' on another ZFS host."""
+        # CMD: zol-replicate zfs <user@host> destroy -r share/cinder/volume-...
+        return self._replication_helper('zfs', self._remote_host(settings),
+                                        *cmd, **kwargs)
+
+    def _secondary_zfs(self, *cmd, **kwargs):
+        return self._remote_zfs(self._get_replication_device(), *cmd,
+                                **kwargs)
+
+    def _send_snapshot(self, settings, remote_name, *send):
+        """Send a snapshot to another ZFS host ('send' being the zfs send
+        options and snapshots), and receive it there as 'remote_name'.
+        """
+        # CMD: zol-replicate send <user@host> share/cinder/volume-... -I <vol>@<prev> <vol>@<new>
+        self._replication_helper('send', self._remote_host(settings),
+                                 remote_name, *send, check_exit_code=True)
+
+    def _send_volume(self, settings, remote_name, snap_path, base=None):
+        """Send a volume, up to the snapshot 'snap_path', to another host.
+
+        Sent incrementally from 'base', a snapshot the other host has as
+        well, if given. Else all of it is sent, replacing what the other
+        host has. The snapshots in between, Cinder's included, are sent
+        as well.
+        """
+        if not base:
+            self._remote_zfs(settings, 'destroy', '-r', remote_name,
+                             check_exit_code=False)
+            snapshots = self._list_datasets(snap_path.split('@')[0],
+                                            types='snapshot',
+                                            props=('name', 'createtxg'))
+            snapshots.sort(key=lambda snap: int(snap['createtxg']))
+            base = snapshots[0]['name']
+            self._send_snapshot(settings, remote_name, base)
+            if base == snap_path:
+                return
+        self._send_snapshot(settings, remote_name, '-I', base, snap_path)
+
+    def _volume_lock(self, volume_name):
+        """Lock a volume against being replicated at the same time.
+
+        Taken by the replication and by everything that destroys or
+        rolls back snapshots of the volume (or clones one of them).
+        """
+        return lockutils.lock('zol-' + volume_name)
+
+    def _secondary_name(self, volume_name):
+        return '%s/%s' % (self._get_replication_device()['san_zfs_volume_base'],
+                          volume_name)
+
+    @traced
+    def _replicate_volumes(self):
+        """Ship a new snapshot of all replicated volumes to the secondary.
+
+        Called every 'zol_replication_interval' seconds. Volumes are
+        replicated in parallel, at most 'zol_replication_concurrency'
+        at a time.
+        """
+        if self._active_backend_id not in (None, 'default'):
+            # We're failed over, nothing to replicate to.
+            return
+
+        LOG.debug('Replicating volumes')
+        base = self.configuration.san_zfs_volume_base
+        try:
+            datasets = self._list_datasets(base,
+                                           props=('name', 'type', 'creation',
+                                                  self.REPLICATION_PROPERTY))
+
+            # Collect the replicated volumes and their replication snapshots.
+            # A volume is always listed before its snapshots.
+            volumes = {}
+            for dataset in datasets:
+                name = dataset['name'][len(base) + 1:]
+                if dataset['type'] == 'volume':
+                    if dataset[self.REPLICATION_PROPERTY] == 'on':
+                        volumes[name] = []
+                elif dataset['type'] == 'snapshot':
+                    volume_name, snap_name = name.split('@', 1)
+                    if volume_name in volumes and \
+                            snap_name.startswith(self.REPLICATION_PREFIX):
+                        volumes[volume_name].append(dataset)
+
+            for volume_name in set(self._replication_synced) - set(volumes):
+                del self._replication_synced[volume_name]
+
+            replicate = self._replicate_volume
+            if self._tracer:
+                replicate = self._tracer.bind(replicate)
+            pool = greenpool.GreenPool(
+                self.configuration.zol_replication_concurrency)
+            for _result in pool.imap(replicate,
+                                     volumes.keys(), volumes.values()):
+                pass
+        except Exception:
+            # Don't let a failure stop the looping call.
+            LOG.exception(_LE('Error replicating volumes'))
+
+    def _replicate_volume(self, volume_name, snapshots):
+        """Snapshot one volume and send it incrementally to the secondary.
+
+        The latest replication snapshot of a volume is always the last
+        one successfully received by the secondary, so it's the base of
+        the next incremental send.
+        """
+        with self._volume_lock(volume_name):
+            return self._replicate_locked_volume(volume_name, snapshots)
+
+    def _replicate_locked_volume(self, volume_name, snapshots):
+        zfs_poolname = self._build_zfs_poolname(volume_name)
+        snapshots = sorted(snapshots, key=lambda snap: int(snap['creation']))
+        if snapshots and volume_name not in self._replication_synced:
+            self._replication_synced[volume_name] = \
+                int(snapshots[-1]['creation'])
+
+        now = int(time.time())
+        snap_name = '%s%d' % (self.REPLICATION_PREFIX, now)
+        snap_path = '%s@%s' % (zfs_poolname, snap_name)
+        try:
+            self._execute(CONF.san_zfs_command, 'snapshot', snap_path,
+                          run_as_root=True, check_exit_code=True)
+
+            if snapshots:
+                self._send_incremental(volume_name, snapshots[-1]['name'],
+                                       snap_path)
+            else:
+                # Nothing in common with the secondary, start from scratch.
+                self._send_volume(self._get_replication_device(),
+                                  self._secondary_name(volume_name),
+                                  snap_path)
+        except processutils.ProcessExecutionError as exc:
+            LOG.error(_LE('Replication of %(vol)s failed: %(err)s'),
+                      {'vol': volume_name, 'err': exc.stderr})
+            self._execute(CONF.san_zfs_command, 'destroy', snap_path,
+                          run_as_root=True, check_exit_code=False)
+            return False
+
+        self._replication_synced[volume_name] = now
+
+        # Prune the replication snapshots we don't need anymore.
+        keep = max(1, self.configuration.zol_replication_keep)
+        names = [snap['name'].split('@')[1] for snap in snapshots]
+        names.append(snap_name)
+        prune = ','.join(names[:-keep])
+        if prune:
+            self._execute(CONF.san_zfs_command, 'destroy',
+                          '%s@%s' % (zfs_poolname, prune),
+                          run_as_root=True, check_exit_code=False)
+            self._secondary_zfs('destroy', '%s@%s' % (
+                self._secondary_name(volume_name), prune),
+                check_exit_code=False)
+        return True
+
+    def _send_incremental(self, volume_name, base_path, snap_path):
+        """Send snap_path incrementally from base_path to the secondary.
+
+        If that fails because the secondary doesn't have the base (any
+        more), the whole volume is sent again. If it has snapshots newer
+        than the base (a send that failed after the receive, a revert),
+        it's rolled back to the base first.
+        """
+        device = self._get_replication_device()
+        remote_name = self._secondary_name(volume_name)
+        base = base_path.split('@')[1]
+        try:
+            self._send_volume(device, remote_name, snap_path, base_path)
+            return
+        except processutils.ProcessExecutionError as exc:
+            with excutils.save_and_reraise_exception() as ctxt:
+                remote = self._secondary_snapshots(volume_name)
+                if base not in remote:
+                    LOG.warning(_LW('Secondary copy of %(vol)s has no '
+                                    'snapshot %(snap)s, sending all of it: '
+                                    '%(err)s'),
+                                {'vol': volume_name, 'snap': base,
+                                 'err': exc.stderr})
+                    ctxt.reraise = False
+                elif remote[-1] != base:
+                    LOG.warning(_LW('Secondary copy of %(vol)s has snapshots '
+                                    'newer than %(snap)s, rolling it back: '
+                                    '%(err)s'),
+                                {'vol': volume_name, 'snap': base,
+                                 'err': exc.stderr})
+                    ctxt.reraise = False
+
+        if base not in remote:
+            self._send_volume(device, remote_name, snap_path)
+        else:
+            self._secondary_zfs('rollback', '-r',
+                                '%s@%s' % (remote_name, base),
+                                check_exit_code=True)
+            self._send_volume(device, remote_name, snap_path, base_path)
+
+    def _secondary_snapshots(self, volume_name):
+        """Names of the snapshots of the secondary copy, oldest first."""
+        try:
+            (out, _err) = self._secondary_zfs(
+                'list', '-Hr', '-t', 'snapshot', '-o', 'name',
+                '-s', 'createtxg', self._secondary_name(volume_name),
+                check_exit_code=True)
+        except processutils.ProcessExecutionError:
+            # There's no secondary copy.
+            return []
+        return [line.split('@', 1)[1] for line in out.splitlines()
+                if '@' in line]
+
+    def _delete_replica(self, volume_name):
+        """Remove the replication snapshots and the secondary copy."""
+        zfs_poolname = self._build_zfs_poolname(volume_name)
+        self._replication_synced.pop(volume_name, None)
+
+        # The replication snapshots would stop the volume from being destroyed.
+        try:
+            snapshots = [snap['name'].split('@')[1]
+                         for snap in self._list_datasets(zfs_poolname,
+                                                         types='snapshot',
+                                                         props=('name',))
+                         if snap['name'].split('@')[1].startswith(
+                             self.REPLICATION_PREFIX)]
+        except processutils.ProcessExecutionError:
+            # The volume is already gone.
+            snapshots = []
+        if snapshots:
+            self._execute(CONF.san_zfs_command, 'destroy',
+                          '%s@%s' % (zfs_poolname, ','.join(snapshots)),
+                          run_as_root=True)
+
+        if self._active_backend_id in (None, 'default'):
+            self._secondary_zfs('destroy', '-r',
+                                self._secondary_name(volume_name),
+                                check_exit_code=False)
+
+    def _switch_backend(self, settings):
+        """Point the driver at another ZFS host (and volume base)."""
+        LOG.info(_LI('Switching to ZFS host %(ip)s, volume base %(base)s'),
+                 {'ip': settings['san_ip'],
+                  'base': settings['san_zfs_volume_base']})
+
+        self.configuration.san_ip = settings['san_ip']
+        self.configuration.san_login = settings.get(
+            'san_login', self._primary_backend['san_login'])
+        self.configuration.san_zfs_volume_base = \
+            settings['san_zfs_volume_base']
+
+        # The secondary is always reached over SSH, and the pooled
+        # connections are to the old host.
+        self.run_local = settings.get('run_local', False)
+        self.sshpool = None
+
+        # The spares are on the old host.
+        with self._warm_lock:
+            self._warm_spares = {}
+            self._warm_taken = set()
+
+        self._active_backend_id = settings.get('backend_id', 'default')
+
+    @traced
+    def failover_host(self, context, volumes, secondary_id=None):
+        """Failover to the replication_device.
+
+        A secondary_id of 'default' fails back to the primary, after
+        sending the replicated volumes back to it from the secondary.
+        """
+        LOG.debug('failover_host(%s)', secondary_id)
+
+        if secondary_id == 'default':
+            if self._active_backend_id in (None, 'default'):
+                raise exception.InvalidReplicationTarget(
+                    reason=_('Not failed over, cannot fail back.'))
+            self._failback(volumes)
+            replication_status = 'enabled'
+        else:
+            device = self._get_replication_device(secondary_id)
+            if self._active_backend_id == device['backend_id']:
+                raise exception.InvalidReplicationTarget(
+                    reason=_('Already failed over to %s.') %
+                    device['backend_id'])
+            self._switch_backend(device)
+            replication_status = 'failed-over'
+
+        volume_updates = []
+        for volume in volumes:
+            if self._is_replicated(volume):
+                updates = {'replication_status': replication_status}
+            elif replication_status == 'failed-over':
+                # Not on the secondary, so it can't be used anymore.
+                updates = {'status': 'error'}
+            else:
+                continue
+            volume_updates.append({'volume_id': volume['id'],
+                                   'updates': updates})
+
+        return self._active_backend_id, volume_updates
+
+    def _failback(self, volumes):
+        """Switch back to the primary host and restart the replication.
+
+        What was written to the replicated volumes while failed over is
+        first sent back to the primary, from the secondary. If that
+        fails for any volume, we stay on the secondary.
+        """
+        primary = dict(self._primary_backend)
+        primary['san_ip'] = self._get_replication_device().get(
+            'primary_san_ip', primary['san_ip'])
+        if not primary['san_ip']:
+            raise exception.UnableToFailOver(
+                reason=_('Address of the primary unknown, set primary_san_ip '
+                         'in the replication_device.'))
+
+        for volume in volumes:
+            if self._is_replicated(volume):
+                with self._volume_lock(volume['name']):
+                    self._send_to_primary(volume['name'], primary)
+
+        self._switch_backend(self._primary_backend)
+        self._replication_synced = {}
+
+    def _send_to_primary(self, volume_name, primary):
+        """Send a volume back to the primary, while failed over to the
+        secondary.
+
+        Sent incrementally from the latest replication snapshot, which
+        the primary has as well. Volumes without one (created while
+        failed over) are sent as a whole.
+        """
+        zfs_poolname = self._build_zfs_poolname(volume_name)
+        snapshots = self._list_datasets(zfs_poolname, types='snapshot',
+                                        props=('name', 'createtxg'))
+        snapshots.sort(key=lambda snap: int(snap['createtxg']))
+        snapshots = [snap['name'] for snap in snapshots
+                     if snap['name'].split('@')[1].startswith(
+                         self.REPLICATION_PREFIX)]
+
+        snap_path = '%s@%s%d' % (zfs_poolname, self.REPLICATION_PREFIX,
+                                 int(time.time()))
+        try:
+            self._execute(CONF.san_zfs_command, 'snapshot', snap_path,
+                          run_as_root=True, check_exit_code=True)
+            self._send_volume(primary, '%s/%s' % (
+                primary['san_zfs_volume_base'], volume_name), snap_path,
+                snapshots[-1] if snapshots else None)
+        except processutils.ProcessExecutionError as exc:
+            self._execute(CONF.san_zfs_command, 'destroy', snap_path,
+                          run_as_root=True, check_exit_code=False)
+            raise exception.UnableToFailOver(
+                reason=_('Cannot send %(vol)s back to the primary: '
+                         '%(err)s') % {'vol': volume_name,
+                                       'err': exc.stderr})
+
+    @traced
     def _update_volume_stats(self):
         """Retrieve stats info from volume group."""
         LOG.debug("Updating volume stats")
@@ -326,6 +1686,17 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
             multiattach=False,
             encryption_support=supports_encryption
         ))
+        if self._replication_device:
+            now = time.time()
+            single_pool.update(dict(
+                replication_enabled=True,
+                replication_type=['async'],
+                replication_count=1,
+                replication_targets=[self._replication_device['backend_id']],
+                replication_lag=dict(
+                    (name, int(now - synced))
+                    for name, synced in self._replication_synced.items())
+            ))
         data["pools"].append(single_pool)
 
         # Check availability of sparse volume copy.
@@ -343,6 +1714,7 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
 
         return self._stats
 
+    @traced
     def extend_volume(self, volume, new_size):
         """Extend an existing volume's size."""
         LOG.debug('extend_volume(%s, %d)', volume['name'], new_size)
@@ -358,8 +1730,8 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
 
     def _rename_volume(self, old_name, new_name):
         # See if this target is logged in.
-        target = self._get_iscsi_sessions(old_name)
-        if target:
+        target = self._find_dataset_target(old_name)
+        if target and self._get_iscsi_sessions(target):
             # Yes. Logout the target.
             if not self._logout_target(self.configuration.san_ip + ':' +
                                        str(self.configuration.iscsi_port),
@@ -370,44 +1742,362 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
         # Rename volume.
         try:
             self._execute(CONF.san_zfs_command, 'rename',
-                          old_name, new_name, zfs_poolname,
-                          run_as_root=True)
-        except putils.ProcessExecutionError:
+                          old_name, new_name, run_as_root=True,
+                          check_exit_code=True)
+        except processutils.ProcessExecutionError:
             with excutils.save_and_reraise_exception():
                 LOG.exception('Error renaming volume')
-                                            
+        return True
+
+    def _list_datasets(self, root, types='volume,snapshot',
+                       props=('name', 'type', 'volsize', 'used')):
+        """List all datasets below 'root' with one 'zfs list' call.
+
+        Returns a list of dicts (one per dataset, keyed by 'props'),
+        sorted on the dataset name. Numbers are in parsable (-p) form.
+        """
+        LOG.debug('_list_datasets(%s, %s)', root, types)
+
+        # CMD: zfs list -Hpr -t volume,snapshot -o name,type,volsize,used share/cinder
+        (out, _err) = self._execute(CONF.san_zfs_command, 'list', '-Hpr',
+                                    '-t', types, '-o', ','.join(props),
+                                    root, run_as_root=True,
+                                    check_exit_code=True)
+        records = []
+        for line in out.splitlines():
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) != len(props):
+                continue
+            records.append(dict(zip(props, fields)))
+
+        records.sort(key=lambda r: r['name'])
+        return records
+
+    def _size_in_gb(self, size):
+        """Round a parsable ZFS size (in bytes) up to whole gigabytes."""
+        try:
+            return int(math.ceil(float(size) / units.Gi))
+        except ValueError:
+            return 0
+
+    def _extract_cinder_id(self, name, template):
+        """Get the UUID out of a name built from a Cinder name template."""
+        prefix, _sep, suffix = template.partition('%s')
+        if not name.startswith(prefix) or not name.endswith(suffix):
+            return None
+
+        candidate = name[len(prefix):len(name) - len(suffix)]
+        if uuidutils.is_uuid_like(candidate):
+            return candidate
+        return None
+
+    def _get_manageable_resources(self, cinder_resources, resource_type,
+                                  marker, limit, offset, sort_keys,
+                                  sort_dirs):
+        """Build the list of manageable volumes or snapshots.
+
+        All datasets are fetched with a single 'zfs list', no matter how
+        many there are, and the result is paginated here.
+        """
+        base = self.configuration.san_zfs_volume_base
+        cinder_ids = set(resource['id'] for resource in cinder_resources)
+
+        entries = []
+        for dataset in self._list_datasets(base,
+                                           props=('name', 'type', 'volsize',
+                                                  'used', 'shareiscsi')):
+            if dataset['type'] != resource_type:
+                continue
+
+            # Only direct children of the volume base are ours to manage.
+            name = dataset['name'][len(base) + 1:]
+            if '/' in name.split('@')[0]:
+                continue
+
+            if resource_type == 'volume':
+                potential_id = self._extract_cinder_id(
+                    name, CONF.volume_name_template)
+            else:
+                # Snapshot names are only unique together with their volume.
+                volume_name, snap_name = name.split('@', 1)
+                potential_id = self._extract_cinder_id(
+                    snap_name, CONF.snapshot_name_template)
+
+            entry = {'reference': {'source-name': name},
+                     'size': self._size_in_gb(dataset['volsize']),
+                     'cinder_id': None,
+                     'extra_info': None}
+            # A Cinder name unknown to Cinder is left by unmanage, and
+            # can be managed again.
+            if potential_id in cinder_ids:
+                entry['safe_to_manage'] = False
+                entry['reason_not_safe'] = _('already managed')
+                entry['cinder_id'] = potential_id
+            elif resource_type == 'snapshot' and \
+                    snap_name.startswith(self.REPLICATION_PREFIX):
+                entry['safe_to_manage'] = False
+                entry['reason_not_safe'] = _('used for replication')
+            elif dataset['shareiscsi'] == 'on':
+                entry['safe_to_manage'] = False
+                entry['reason_not_safe'] = _('%s is shared') % resource_type
+            else:
+                entry['safe_to_manage'] = True
+                entry['reason_not_safe'] = None
+
+            if resource_type == 'snapshot':
+                entry['source_reference'] = {'source-name': volume_name}
+            entries.append(entry)
+
+        return self._paginate_entries(entries, marker, limit, offset,
+                                      sort_keys, sort_dirs)
+
+    def _paginate_entries(self, entries, marker, limit, offset,
+                          sort_keys, sort_dirs):
+        """Sort and page a list of manageable entries.
+
+        'entries' are expected to already be sorted on the reference name
+        (as returned by _list_datasets), so the default sort is free.
+        """
+        sort_keys = [key.strip() for key in sort_keys or ['reference']]
+        sort_dirs = sort_dirs or ['asc'] * len(sort_keys)
+
+        def _key(entry, key):
+            if key == 'reference':
+                return entry['reference']['source-name']
+            return entry[key]
+
+        # Sorts are stable, so sort on the least significant key first.
+        if (sort_keys, list(sort_dirs)) != (['reference'], ['asc']):
+            for key, direction in reversed(list(zip(sort_keys, sort_dirs))):
+                entries.sort(key=lambda e: _key(e, key),
+                             reverse=(direction == 'desc'))
+
+        start = 0
+        if marker:
+            marker_name = marker.get('source-name', marker) \
+                if isinstance(marker, dict) else marker
+            for i, entry in enumerate(entries):
+                if entry['reference']['source-name'] == marker_name:
+                    start = i + 1
+                    break
+            else:
+                msg = _('marker not found: %s') % marker
+                raise exception.InvalidInput(reason=msg)
+
+        start += offset or 0
+        if limit is None:
+            return entries[start:]
+        return entries[start:start + limit]
+
+    @traced
+    def get_manageable_volumes(self, cinder_volumes, marker, limit, offset,
+                               sort_keys, sort_dirs):
+        """List volumes on the backend available for management by Cinder."""
+        LOG.debug('get_manageable_volumes(marker=%s, limit=%s, offset=%s)',
+                  marker, limit, offset)
+        return self._get_manageable_resources(cinder_volumes, 'volume',
+                                              marker, limit, offset,
+                                              sort_keys, sort_dirs)
+
+    @traced
+    def get_manageable_snapshots(self, cinder_snapshots, marker, limit,
+                                 offset, sort_keys, sort_dirs):
+        """List snapshots on the backend available for management by Cinder."""
+        LOG.debug('get_manageable_snapshots(marker=%s, limit=%s, offset=%s)',
+                  marker, limit, offset)
+        return self._get_manageable_resources(cinder_snapshots, 'snapshot',
+                                              marker, limit, offset,
+                                              sort_keys, sort_dirs)
+
+    def _get_existing_source(self, existing_ref):
+        """Get (and verify) the 'source-name' of a manage reference."""
+        source = existing_ref.get('source-name')
+        if not source:
+            reason = _('Reference must contain source-name element.')
+            raise exception.ManageExistingInvalidReference(
+                existing_ref=existing_ref, reason=reason)
+
+        return source
+
+    def _get_existing_volsize(self, zfs_name, existing_ref):
+        try:
+            # CMD: zfs get -Hpovalue volsize share/cinder/myvol
+            (out, _err) = self._execute(CONF.san_zfs_command,
+                                        'get', '-Hpovalue', 'volsize',
+                                        zfs_name, run_as_root=True,
+                                        check_exit_code=True)
+        except processutils.ProcessExecutionError:
+            reason = _('Specified dataset does not exist.')
+            raise exception.ManageExistingInvalidReference(
+                existing_ref=existing_ref, reason=reason)
+
+        # Filesystems (and their snapshots) have no volsize.
+        if not out.strip().isdigit():
+            reason = _('Specified dataset is not a volume.')
+            raise exception.ManageExistingInvalidReference(
+                existing_ref=existing_ref, reason=reason)
+
+        return self._size_in_gb(out.strip())
+
+    def _get_existing_volume(self, existing_ref):
+        """Get the full ZFS name of the volume in 'existing_ref'.
+
+        Only volumes directly below the volume base can be managed,
+        the same ones that get_manageable_volumes() lists.
+        """
+        source = self._get_existing_source(existing_ref)
+        if '/' in source or '@' in source:
+            reason = _('Only volumes directly below %s can be managed.') % \
+                self.configuration.san_zfs_volume_base
+            raise exception.ManageExistingInvalidReference(
+                existing_ref=existing_ref, reason=reason)
+        return self._build_zfs_poolname(source)
+
+    @traced
+    def manage_existing_get_size(self, volume, existing_ref):
+        """Return size of volume to be managed by manage_existing."""
+        LOG.debug('manage_existing_get_size: existing_ref=%s', existing_ref)
+
+        return self._get_existing_volsize(
+            self._get_existing_volume(existing_ref), existing_ref)
+
+    @traced
     def manage_existing(self, volume, existing_ref):
         """Manages an existing volume.
 
         Renames the volume to match the expected name for the volume.
-        Error checking done by manage_existing_get_size is not repeated.
         """
         LOG.debug('manage_existing: volume=%s', volume)
         LOG.debug('manage_existing: existing_ref=%s', existing_ref)
 
-        if not self._volume_present(volume['name']):
-            # If the volume isn't present, then don't attempt to delete
-            LOG.debug("VOLUME NOT FOUND (%s)" % (volume['name']))
-            return True
+        vol_src = self._get_existing_volume(existing_ref)
+        self._get_existing_volsize(vol_src, existing_ref)
 
-        vol_src = self._build_zfs_poolname(existing_ref['source-name'])
-        if volutils.check_already_managed_volume(vol_src):
-            raise exception.ManageExistingAlreadyManaged(volume_ref=vol_src)
+        source = self._get_existing_source(existing_ref)
+        vol_id = self._extract_cinder_id(source, CONF.volume_name_template)
+        if vol_id:
+            try:
+                self.db.volume_get(cinder_context.get_admin_context(), vol_id)
+            except exception.VolumeNotFound:
+                pass
+            else:
+                raise exception.ManageExistingAlreadyManaged(volume_ref=source)
 
         # Attempt to rename the volume to match the OpenStack internal name.
         vol_dst = self._build_zfs_poolname(volume['name'])
         try:
-            self._rename_volume(vol_src, vol_dst)
-        except putils.ProcessExecutionError as exc:
+            renamed = self._rename_volume(vol_src, vol_dst)
+        except processutils.ProcessExecutionError as exc:
             exception_message = (_("Failed to rename volume %(name)s, "
                                    "error message was: %(err_msg)s")
                                  % {'name': vol_src,
                                     'err_msg': exc.stderr})
             raise exception.VolumeBackendAPIException(data=exception_message)
-                                
+        if not renamed:
+            exception_message = (_("Failed to rename volume %s, cannot "
+                                   "logout its iSCSI sessions") % vol_src)
+            raise exception.VolumeBackendAPIException(data=exception_message)
+
+        if self._replication_device:
+            replicated = self._is_replicated(volume)
+            self._set_replicated(vol_dst, replicated)
+            if replicated:
+                return {'replication_status': 'enabled'}
+
+    @traced
     def unmanage(self, volume):
-        # TODO
-        pass
+        """Removes the specified volume from Cinder management.
+
+        The export has already been removed by remove_export, and the
+        dataset itself is left as is on the ZFS host, except that it's
+        not replicated anymore.
+        """
+        LOG.debug('unmanage(%s)', volume['name'])
+
+        if self._replication_device:
+            with self._volume_lock(volume['name']):
+                self._delete_replica(volume['name'])
+                self._set_replicated(
+                    self._build_zfs_poolname(volume['name']), False)
+
+    @traced
+    def retype(self, context, volume, new_type, diff, host):
+        """Change the volume type of a volume on this backend.
+
+        Only replication_enabled changes anything on the ZFS host, as
+        the other ZFS options are set from the configuration.
+        """
+        LOG.debug('retype(%s, %s)', volume['name'], new_type['id'])
+
+        if volume_utils.extract_host(host['host'], 'backend') != \
+                volume_utils.extract_host(volume['host'], 'backend'):
+            return False
+
+        replicated = self._is_replicated_type(new_type['id'])
+        if replicated == self._is_replicated(volume):
+            return True
+
+        with self._volume_lock(volume['name']):
+            if not replicated:
+                self._delete_replica(volume['name'])
+            self._set_replicated(self._build_zfs_poolname(volume['name']),
+                                 replicated)
+        return True, {'replication_status':
+                      'enabled' if replicated else 'disabled'}
+
+    def _get_existing_snapshot(self, snapshot, existing_ref):
+        """Get the full ZFS name of the snapshot in 'existing_ref'.
+
+        The reference can be either 'volume@snapshot' or only the
+        snapshot part, in which case the snapshots volume is used.
+        """
+        source = self._get_existing_source(existing_ref)
+        if '@' not in source:
+            source = '%s@%s' % (snapshot['volume_name'], source)
+        return self._build_zfs_poolname(source)
+
+    @traced
+    def manage_existing_snapshot_get_size(self, snapshot, existing_ref):
+        """Return size of snapshot to be managed by manage_existing."""
+        LOG.debug('manage_existing_snapshot_get_size: existing_ref=%s',
+                  existing_ref)
+
+        return self._get_existing_volsize(
+            self._get_existing_snapshot(snapshot, existing_ref),
+            existing_ref)
+
+    @traced
+    def manage_existing_snapshot(self, snapshot, existing_ref):
+        """Brings an existing backend storage object under Cinder management.
+
+        Renames the snapshot to match the expected name for the snapshot.
+        """
+        LOG.debug('manage_existing_snapshot: snapshot=%s', snapshot)
+        LOG.debug('manage_existing_snapshot: existing_ref=%s', existing_ref)
+
+        snap_src = self._get_existing_snapshot(snapshot, existing_ref)
+        if snap_src.split('@')[0] != \
+                self._build_zfs_poolname(snapshot['volume_name']):
+            reason = _('Snapshot does not belong to volume %s.') % \
+                snapshot['volume_name']
+            raise exception.ManageExistingInvalidReference(
+                existing_ref=existing_ref, reason=reason)
+
+        snap_dst = "%s@%s" % (snap_src.split('@')[0], snapshot['name'])
+        try:
+            self._execute(CONF.san_zfs_command, 'rename',
+                          snap_src, snap_dst, run_as_root=True,
+                          check_exit_code=True)
+        except processutils.ProcessExecutionError as exc:
+            exception_message = (_("Failed to rename snapshot %(name)s, "
+                                   "error message was: %(err_msg)s")
+                                 % {'name': snap_src,
+                                    'err_msg': exc.stderr})
+            raise exception.VolumeBackendAPIException(data=exception_message)
+
+    def unmanage_snapshot(self, snapshot):
+        """Removes the specified snapshot from Cinder management."""
+        LOG.debug('unmanage_snapshot(%s)', snapshot['name'])
 
     def _volume_present(self, volume_name):
         zfs_poolname = self._build_zfs_poolname(volume_name)
@@ -426,6 +2116,7 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
             return False
         return False
 
+    @traced
     def create_volume_from_snapshot(self, volume, snapshot):
         """Creates a volume from a snapshot."""
         LOG.debug('create_volume_from_snapshot: volume=%s', volume)
@@ -437,10 +2128,21 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
         LOG.debug('create_volume_from_snapshot: zfs_snap=%s, zfs_vol=%s',
                   zfs_snap, zfs_vol)
         
-        self._execute(CONF.san_zfs_command, 'clone', zfs_snap,
-                      zfs_vol, run_as_root=True)
-        self._execute(CONF.san_zfs_command, 'promote', zfs_vol, run_as_root=True)
+        # Replication destroys (and may roll back) the snapshots, and the
+        # promote moves the older ones from the source volume to the clone.
+        with self._volume_lock('volume-' + snapshot['volume_id']):
+            self._execute(CONF.san_zfs_command, 'clone', zfs_snap,
+                          zfs_vol, run_as_root=True)
+            self._execute(CONF.san_zfs_command, 'promote', zfs_vol,
+                          run_as_root=True)
 
+        if self._is_replicated(volume):
+            self._execute(CONF.san_zfs_command, 'set',
+                          self.REPLICATION_PROPERTY + '=on', zfs_vol,
+                          run_as_root=True)
+            return {'replication_status': 'enabled'}
+
+    @traced
     def delete_volume(self, volume):
         """Deletes a volume."""
         LOG.debug('delete_volume(%s)', volume['name'])
@@ -449,50 +2151,70 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
 
         # Destroy the volume.
         zfs_poolname = self._build_zfs_poolname(volume['name'])
-        if self._execute(CONF.san_zfs_command, 'destroy', zfs_poolname,
-                             run_as_root=True):
-            LOG.debug('Delete volume successful')
-            return True
-        else:
-            LOG.error('Cannot delete volume')
-            return False
+        with self._volume_lock(volume['name']):
+            if self._is_replicated(volume):
+                self._delete_replica(volume['name'])
+            if self._execute(CONF.san_zfs_command, 'destroy', zfs_poolname,
+                                 run_as_root=True):
+                LOG.debug('Delete volume successful')
+                return True
+            else:
+                LOG.error('Cannot delete volume')
+                return False
 
-    def _find_target(self, volume_id):
-        """Get the iSCSI target for the volume.
+    def _discover_targets(self):
+        """Get the iSCSI targets (IQNs) on the SAN.
 
         Similar to iscsi:ISCSITarget:_do_iscsi_discovery()
         However, that uses the Cinder hostname to get targets,
         but since I'm using a remote SAN ('san_ip'), I need to
         discover on that.
         """
-        LOG.debug('_find_target(%s)', volume_id)
         try:
-            (out, _err) = utils.execute('iscsiadm', '-m', 'discovery',
-                                        '-t', 'sendtargets',
-                                        '-p', self.configuration.san_ip +
-                                        ':' + str(self.configuration.iscsi_port),
-                                        '-D', '-o', 'update',
-                                        run_as_root=True)
-            LOG.debug('_find_target: out=%s (%s)', out, _err)
+            (out, _err) = self._host_execute('iscsiadm', '-m', 'discovery',
+                                             '-t', 'sendtargets',
+                                             '-p', self.configuration.san_ip +
+                                             ':' + str(self.configuration.iscsi_port),
+                                             '-D', '-o', 'update',
+                                             run_as_root=True)
+            LOG.debug('_discover_targets: out=%s (%s)', out, _err)
         except processutils.ProcessExecutionError as ex:
             LOG.error("ISCSI discovery attempt failed for: %s",
                       self.configuration.san_ip)
             LOG.debug(("Error from iscsiadm -m discovery: %s") % ex.stderr)
-            return False
+            return []
+
+        portal = self.configuration.san_ip + ':' + str(self.configuration.iscsi_port)
+        return [entry.split( )[1].rstrip('\r\n') for entry in out.splitlines()
+                if portal in entry]
+
+    def _find_target(self, volume_id):
+        """Get the iSCSI target for the volume."""
+        LOG.debug('_find_target(%s)', volume_id)
 
         # Find the IQN of the volume.
         # The 'shareiscsi' replaces all dashes with dots,
         # and we're only interested in the actual IQN..
-        portal = self.configuration.san_ip + ':' + str(self.configuration.iscsi_port)
         volume = 'volume.' + volume_id.replace('-', '.')
-        #LOG.debug("_find_target: portal = '%s'", portal)
-        #LOG.debug("_find_target: volume = '%s'", volume)
-        for entry in out.splitlines():
-            if portal in entry:
-                #LOG.debug("_find_target: entry = '%s'", entry)
-                if volume in entry:
-                    LOG.debug("_find_target: return %s", entry.split( )[1])
-                    return entry.split( )[1].rstrip('\r\n')
+        for target in self._discover_targets():
+            if volume in target:
+                LOG.debug("_find_target: return %s", target)
+                return target
+
+        return False
+
+    def _find_dataset_target(self, zfs_name):
+        """Get the iSCSI target of any (shared) dataset.
+
+        The 'shareiscsi' IQN ends with the dataset name, with
+        slashes and dashes replaced by dots.
+        """
+        LOG.debug('_find_dataset_target(%s)', zfs_name)
+
+        name = ':' + zfs_name.replace('/', '.').replace('-', '.')
+        for target in self._discover_targets():
+            if target.endswith(name):
+                return target
 
         return False
 
@@ -508,9 +2230,9 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
 
         try:
             LOG.debug('_login_target: ISCSI login attempt on %s', target)
-            (out, _err) = utils.execute('iscsiadm', '-m', 'node', '-l',
-                                        '-p', portal, '-T', target,
-                                        run_as_root=True)
+            (out, _err) = self._host_execute('iscsiadm', '-m', 'node', '-l',
+                                             '-p', portal, '-T', target,
+                                             run_as_root=True)
             LOG.debug('_login_target: out="%s" (%s)', out, _err)
         except processutils.ProcessExecutionError as ex:
             LOG.error("ISCSI login attempt failed for: %s:%s",
@@ -532,9 +2254,9 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
         LOG.debug('_logout_target(%s, %s)', portal, target)
 
         try:
-            (out, _err) = utils.execute('iscsiadm', '-m', 'node', '-u',
-                                        '-p', portal, '-T', target,
-                                        run_as_root=True)
+            (out, _err) = self._host_execute('iscsiadm', '-m', 'node', '-u',
+                                             '-p', portal, '-T', target,
+                                             run_as_root=True)
             LOG.debug('_logout_target: out="%s" (%s)', out, _err)
         except processutils.ProcessExecutionError as ex:
             LOG.debug(("Error from iscsiadm -m node: %s") % ex.stderr)
@@ -554,8 +2276,8 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
         LOG.debug('_get_iscsi_sessions(%s)', target)
 
         try:
-            (out, _err) = utils.execute('iscsiadm', '-m', 'session',
-                                        run_as_root=True)
+            (out, _err) = self._host_execute('iscsiadm', '-m', 'session',
+                                             run_as_root=True)
             LOG.debug('_get_iscsi_sessions: out=%s (%s)', out, _err)
         except processutils.ProcessExecutionError as ex:
             LOG.debug(("Error from iscsiadm -m session: %s") % ex.stderr)
@@ -587,9 +2309,9 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
         LOG.debug('_find_iscsi_block_device: target=%s', target)
 
         try:
-            (out, _err) = utils.execute('find', '/dev/disk/by-path', '-name',
-                                        '*' + target + '*',
-                                        run_as_root=True)
+            (out, _err) = self._host_execute('find', '/dev/disk/by-path', '-name',
+                                             '*' + target + '*',
+                                             run_as_root=True)
             if out:
                 dev = out.rstrip('\r\n')
                 bdev = os.path.realpath(dev)
@@ -614,6 +2336,7 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
     def _build_zfs_poolname(self, volume_name):
         return '%s/%s' % (self.configuration.san_zfs_volume_base, volume_name)
 
+    @traced
     def initialize_connection(self, volume, connector=None):
         """Initializes the connection and returns connection info."""
         LOG.debug('initialize_connection(%s)', volume['name_id'])
@@ -655,6 +2378,7 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
             'data': properties,
         }
 
+    @traced
     def terminate_connection(self, volume, connector, **kwargs):
         """Terminate the connection."""
         LOG.debug('terminate_connection(%s)', volume['name_id'])
@@ -694,6 +2418,7 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
     def validate_connector(self, connector):
         return self.target_driver.validate_connector(connector)
 
+    @traced
     def create_export(self, context, volume, connector=None):
         """Creates an export for a logical volume."""
         LOG.debug('create_export(%s)', volume['name_id'])
@@ -716,6 +2441,7 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
             CONF.iscsi_ip_address, target)
         return model_update
 
+    @traced
     def remove_export(self, context, volume):
         """Removes an export for a logical volume."""
         LOG.debug('remove_export(%s)', volume['name_id'])
@@ -755,6 +2481,7 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
                         "id:%(volume_id)s.") % locals())
             raise
 
+    @traced
     def copy_image_to_volume(self, context, volume, image_service, image_id):
         """Fetch the image from image_service and write it to the volume."""
         LOG.debug('copy_image_to_volume(volume=%s, service=%s, image=%s)',
@@ -774,6 +2501,7 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
                                  self.configuration.volume_dd_blocksize,
                                  size=volume['size'])
 
+    @traced
     def copy_volume_to_image(self, context, volume, image_service, image_meta):
         """Copy the volume to the specified image."""
         image_utils.upload_volume(context,
@@ -783,3 +2511,7 @@ class ZFSonLinuxISCSIDriver(san.SanISCSIDriver):
 
     def local_path(self, volume):
         return '/dev/zvol/%s' % self._build_zfs_poolname(volume['name'])
+
+
+if __name__ == '__main__':
+    sys.exit(main())